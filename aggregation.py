@@ -0,0 +1,238 @@
+"""
+Protein aggregation engine
+
+Peptide rows are grouped by protein name: numeric columns are summed and
+other columns keep the value from the first peptide of each protein, exactly
+like groupby().agg(lambda x: x.sum() if numeric else x.iloc[0]), but without
+calling back into Python for every column of every group.
+
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import load_data
+import results_bundle
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of elements numpy reduces at a time, as in its buffered reductions
+BLOCK_SIZE = 8192
+
+# ===== HELPERS =====
+
+def _is_summed(dtype):
+    """Numeric columns are summed, everything else keeps its first value"""
+    try:
+        return np.issubdtype(dtype, np.number)
+    except TypeError:
+        return False
+
+def _pairwise_sum(values, starts, lengths):
+    """Sum runs of rows of a 2-D float array in numpy's pairwise order
+
+    Series.sum() adds values sequentially below 8 elements, in 8 interleaved
+    lanes up to 128 elements, and by recursive halving above that, within
+    blocks of 8192 elements that are then added up in turn. Following the
+    same order for every run at once keeps the sums bit-identical to the
+    per-group lambda.
+    """
+    blocked = lengths > BLOCK_SIZE
+    if blocked.any():
+        sums = _pairwise_sum(values, starts, np.minimum(lengths, BLOCK_SIZE))
+        for offset in range(BLOCK_SIZE, lengths.max(), BLOCK_SIZE):
+            take = lengths > offset
+            sums[take] += _pairwise_sum(values, starts[take] + offset, np.minimum(lengths[take] - offset, BLOCK_SIZE))
+        return sums
+
+    sums = np.zeros((len(starts), values.shape[1]))
+
+    small = lengths < 8
+    for offset in range(7):
+        take = small & (lengths > offset)
+        sums[take] += values[starts[take] + offset]
+
+    medium = (lengths >= 8) & (lengths <= 128)
+    if medium.any():
+        medium_starts, medium_lengths = starts[medium], lengths[medium]
+        blocked = medium_lengths - medium_lengths % 8
+        lane_offsets = np.arange(8)
+        lanes = values[medium_starts[:, None] + lane_offsets]
+        for block in range(1, 16):
+            take = blocked > block * 8
+            lanes[take] += values[medium_starts[take, None] + block * 8 + lane_offsets]
+        total = ((lanes[:, 0] + lanes[:, 1]) + (lanes[:, 2] + lanes[:, 3])) + \
+                ((lanes[:, 4] + lanes[:, 5]) + (lanes[:, 6] + lanes[:, 7]))
+        for offset in range(7):
+            take = blocked + offset < medium_lengths
+            total[take] += values[medium_starts[take] + blocked[take] + offset]
+        sums[medium] = total
+
+    large = lengths > 128
+    if large.any():
+        large_starts, large_lengths = starts[large], lengths[large]
+        half = large_lengths // 2
+        half -= half % 8
+        sums[large] = _pairwise_sum(values, large_starts, half) + \
+                      _pairwise_sum(values, large_starts + half, large_lengths - half)
+
+    return sums
+
+# ===== AGGREGATION =====
+
+def _sum_runs(integer_values, floating_values, starts, lengths):
+    """Sum each run of rows of the integer and float blocks"""
+    integer_sums = np.add.reduceat(integer_values, starts, axis=0) if len(starts) else integer_values
+    return integer_sums, _pairwise_sum(floating_values, starts, lengths)
+
+# Numeric blocks of the rows being aggregated, as seen by worker processes
+_worker_blocks = None
+
+def _set_worker_blocks(integer_values, floating_values):
+    global _worker_blocks
+    _worker_blocks = integer_values, floating_values
+
+def _sum_worker_runs(begin, end, starts, lengths):
+    """Sum the runs within rows begin:end of the worker's numeric blocks"""
+    integer_values, floating_values = _worker_blocks
+    return _sum_runs(integer_values[begin:end], floating_values[begin:end], starts, lengths)
+
+def _sum_runs_in_parallel(integer_values, floating_values, starts, lengths, workers):
+    """Sum the runs in that many processes, each taking a contiguous range of them
+
+    The numeric blocks are handed to the processes once, when they start
+    (where processes are forked, they inherit them without copying), and
+    only the row ranges and the sums go back and forth. Every run is summed
+    whole, so the sums are identical to a single-process run.
+    """
+    bounds = np.searchsorted(np.r_[starts, len(integer_values)], np.linspace(0, len(integer_values), workers + 1))
+    bounds = np.unique(bounds)
+    ranges = [(first, last) for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+    if len(ranges) < 2:
+        return _sum_runs(integer_values, floating_values, starts, lengths)
+
+    print(f"Aggregating {len(ranges)} partitions in parallel")
+    with ProcessPoolExecutor(max_workers=len(ranges), initializer=_set_worker_blocks,
+                             initargs=(integer_values, floating_values)) as pool:
+        parts = list(pool.map(
+            _sum_worker_runs,
+            [starts[first] for first, _ in ranges],
+            [starts[last - 1] + lengths[last - 1] for _, last in ranges],
+            [starts[first:last] - starts[first] for first, last in ranges],
+            [lengths[first:last] for first, last in ranges],
+        ))
+    return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+def aggregate_by_protein(experimental_data, key='Protein names', mask=None, workers=None):
+    """Sum numeric columns and keep the first value of other columns per protein
+
+    With mask, only the rows where it is True are aggregated, so a filter can
+    be applied without first copying the surviving rows. With workers above
+    one, the sums are split across that many processes.
+    """
+    columns = [column for column in experimental_data.columns if column != key]
+
+    codes, proteins = pd.factorize(experimental_data[key], sort=True)
+    rows = np.flatnonzero(codes >= 0 if mask is None else (codes >= 0) & mask)
+    rows = rows[np.argsort(codes[rows], kind='stable')]
+    sorted_codes = codes[rows]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(rows) else rows
+    lengths = np.diff(np.r_[starts, len(rows)])
+    first_rows = rows[starts]
+
+    summed = [column for column in columns if _is_summed(experimental_data[column].dtype)]
+    integer = [column for column in summed if np.issubdtype(experimental_data[column].dtype, np.integer)]
+    floating = [column for column in summed if column not in integer]
+
+    integer_values = experimental_data[integer].to_numpy(dtype=np.int64)[rows]
+    floating_values = np.nan_to_num(experimental_data[floating].to_numpy(dtype=np.float64)[rows], nan=0.0)
+    if workers is not None and workers > 1:
+        integer_sums, floating_sums = _sum_runs_in_parallel(integer_values, floating_values, starts, lengths, workers)
+    else:
+        integer_sums, floating_sums = _sum_runs(integer_values, floating_values, starts, lengths)
+
+    aggregated = {key: proteins[sorted_codes[starts]]}
+    aggregated.update(zip(integer, integer_sums.T))
+    aggregated.update(zip(floating, floating_sums.T))
+    for column in columns:
+        if column not in aggregated:
+            aggregated[column] = experimental_data[column].iloc[first_rows].reset_index(drop=True)
+
+    return pd.DataFrame(aggregated, columns=[key] + columns)
+
+# ===== INCREMENTAL AGGREGATION =====
+
+def get_aggregation_parameters(experiment_list, significance_threshold, msms_count_threshold, normalization=None):
+    """Describe the filters and normalization that produced an aggregated table"""
+    return {
+        'experiment_list': [list(entry) if isinstance(entry, tuple) else entry for entry in experiment_list],
+        'significance_threshold': float(significance_threshold),
+        'msms_count_threshold': float(msms_count_threshold),
+        'normalization': normalization,
+    }
+
+def save_aggregation_parameters(parameters, results_dir="results"):
+    """Store the filter parameters next to aggregated_data.csv"""
+    with open(os.path.join(results_dir, "aggregation_parameters.json"), 'w') as handle:
+        json.dump(parameters, handle, indent=2)
+
+def load_aggregated_data(parameters, results_dir="results"):
+    """Load a previous aggregated table to merge new peptides into
+
+    Refuses to load it unless it was produced with the same experiments and
+    thresholds, since the sums could not be combined otherwise. The most
+    recently saved table is loaded, whether in a bundle or not.
+    """
+    parameters_path = os.path.join(results_dir, "aggregation_parameters.json")
+    if not os.path.exists(parameters_path):
+        raise ValueError(f"No aggregation parameters found in {results_dir}; cannot append")
+    with open(parameters_path) as handle:
+        previous = json.load(handle)
+    for name, value in parameters.items():
+        if previous.get(name) != value:
+            raise ValueError(
+                f"Cannot append: {name} was {previous.get(name)!r} for the existing results, not {value!r}"
+            )
+    bundle_dir = os.path.join(results_dir, results_bundle.BUNDLE_DIR)
+    bundle_path = os.path.join(bundle_dir, f"{results_bundle.BASE_TABLE}.parquet")
+    try:
+        aggregated_path = load_data.get_aggregated_path(results_dir)
+    except FileNotFoundError:
+        aggregated_path = None
+    if results_bundle.BASE_TABLE in results_bundle.read_index(bundle_dir) and (
+            aggregated_path is None or os.path.getmtime(bundle_path) >= os.path.getmtime(aggregated_path)):
+        return results_bundle.read_table(bundle_dir, results_bundle.BASE_TABLE)
+    if aggregated_path is None:
+        raise FileNotFoundError(f"No aggregated_data table in {results_dir}")
+    return load_data.load_aggregated(aggregated_path)
+
+def merge_aggregates(existing_data, new_data, key='Protein names'):
+    """Merge newly aggregated proteins into an existing aggregated table
+
+    Numeric columns of proteins found in both tables are added together and
+    other columns keep their existing value; new proteins are inserted in
+    order. Only the affected proteins are touched.
+    """
+    if list(existing_data.columns) != list(new_data.columns):
+        raise ValueError("Cannot append: the new data has different columns from the existing results")
+
+    existing_data = existing_data.set_index(key)
+    new_data = new_data.set_index(key)
+    summed = [
+        column for column in existing_data.columns
+        if _is_summed(existing_data[column].dtype) and _is_summed(new_data[column].dtype)
+    ]
+
+    common = new_data.index.intersection(existing_data.index)
+    existing_rows = existing_data.index.get_indexer(common)
+    new_rows = new_data.index.get_indexer(common)
+    for column in summed:
+        values = existing_data[column].to_numpy(
+            dtype=np.result_type(existing_data[column].dtype, new_data[column].dtype), copy=True
+        )
+        values[existing_rows] += new_data[column].to_numpy()[new_rows]
+        existing_data[column] = values
+
+    added = new_data.loc[new_data.index.difference(existing_data.index)]
+    merged = pd.concat([existing_data, added]) if len(added) else existing_data
+    return merged.sort_index().reset_index()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Run sort_data_master over many MaxQuant runs without prompts
+
+The manifest (JSON, TOML or YAML) lists one job per run, plus optional
+defaults shared by every job:
+
+    {
+        "defaults": {"significance_threshold": 0.05, "msms_count_threshold": 2},
+        "jobs": [
+            {"input_file": "run1/peptides.txt",
+             "experiment_list": [["Exp1", "Ctrl1"], ["Exp2", "Ctrl2"]],
+             "log2fc_selection": "1/2",
+             "results_dir": "results/run1"},
+            {"input_file": "run2/peptides.txt",
+             "experiment_list": ["Exp1", "Exp2", "Exp3"],
+             "log2fc_selection": "3/1"}
+        ]
+    }
+
+Experiments given as [experiment, control] pairs are processed with
+controls, plain names without. The other keys are the keyword arguments of
+process_with_controls / process_without_controls. Relative paths are
+resolved against the manifest's directory. Every job's options and
+experiments are checked before any job runs.
+
+"""
+
+import os
+import sys
+import json
+import inspect
+import argparse
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import imputation
+import load_data
+import replicate_stats
+import sort_data_master as master
+
+# ===== MANIFEST =====
+
+# Options holding paths, resolved against the manifest's directory
+PATH_KEYS = ('input_file', 'results_dir', 'profile', 'profile_dump')
+
+# Options restricted to a set of values
+CHOICES = {
+    'normalization': master.NORMALIZATIONS,
+    'impute': imputation.IMPUTATIONS,
+    'aggregated_format': load_data.AGGREGATED_FORMATS,
+}
+
+# Options that must be non-negative integers
+INTEGER_KEYS = ('chunksize', 'top_k', 'workers', 'seed')
+
+def read_manifest(manifest_path):
+    """Read a JSON, TOML or YAML manifest"""
+    extension = os.path.splitext(manifest_path)[1].lower()
+    if extension == '.toml':
+        import tomllib
+        with open(manifest_path, 'rb') as handle:
+            return tomllib.load(handle)
+    if extension in ('.yaml', '.yml'):
+        import yaml
+        with open(manifest_path) as handle:
+            return yaml.safe_load(handle)
+    with open(manifest_path) as handle:
+        return json.load(handle)
+
+def get_jobs(manifest, manifest_dir="."):
+    """Expand a manifest into validated keyword arguments for each job"""
+    allowed = set(inspect.signature(master.process_with_controls).parameters)
+    defaults = manifest.get('defaults', {})
+    jobs = []
+
+    for number, entry in enumerate(manifest['jobs'], start=1):
+        job = {**defaults, **entry}
+        unknown = set(job) - allowed - {'input_file'}
+        if unknown:
+            raise ValueError(f"Job {number}: unknown keys {sorted(unknown)}")
+        for key in ('input_file', 'experiment_list', 'significance_threshold', 'msms_count_threshold'):
+            if job.get(key) is None:
+                raise ValueError(f"Job {number}: '{key}' is required")
+
+        experiment_list = [
+            tuple(name) if isinstance(name, (list, tuple)) else name
+            for name in job['experiment_list']
+        ]
+        job['experiment_list'] = experiment_list
+
+        stem = os.path.basename(os.path.dirname(os.path.abspath(os.path.join(manifest_dir, job['input_file']))))
+        job.setdefault('results_dir', os.path.join('results', f'{number}_{stem}'))
+        for key in PATH_KEYS:
+            if job.get(key) is not None:
+                job[key] = os.path.join(manifest_dir, job[key])
+        # Replicates are a JSON file or a JSON string
+        if isinstance(job.get('replicates'), str) and os.path.exists(os.path.join(manifest_dir, job['replicates'])):
+            job['replicates'] = os.path.join(manifest_dir, job['replicates'])
+
+        # Only reads the header, so every job is checked before any of them runs
+        try:
+            check_options(job)
+            master.preflight(job['input_file'], experiment_list, evidence=job.get('evidence', False))
+        except (OSError, ValueError) as error:
+            raise ValueError(f"Job {number}: {error}") from error
+        jobs.append(job)
+
+    return jobs
+
+def check_options(job):
+    """Check the option values of a job, raising ValueError on the first bad one"""
+    if len(job['experiment_list']) > 1:
+        load_data.check_log2fc_selection(job.get('log2fc_selection'), len(job['experiment_list']))
+    for key, choices in CHOICES.items():
+        if job.get(key) is not None and job[key] not in choices:
+            raise ValueError(f"'{key}' must be one of {', '.join(choices)}, not {job[key]!r}")
+    for key in INTEGER_KEYS:
+        value = job.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            raise ValueError(f"'{key}' must be a non-negative integer, not {value!r}")
+    if job.get('replicates') is not None:
+        try:
+            replicates = replicate_stats.read_replicates(job['replicates'])
+        except ValueError as error:
+            raise ValueError(f"'replicates' is neither a JSON file nor valid JSON ({error})") from error
+        experiments = {entry[0] if isinstance(entry, tuple) else entry for entry in job['experiment_list']}
+        unknown = {name for names in replicates.values() for name in names} - experiments
+        if unknown:
+            raise ValueError(f"Replicates not among the experiments: {sorted(unknown)}")
+
+# ===== EXECUTION =====
+
+def run_job(job):
+    """Run one job, logging its output to the job's results directory"""
+    job = dict(job)
+    input_file = job.pop('input_file')
+    os.makedirs(job['results_dir'], exist_ok=True)
+
+    with_controls = isinstance(job['experiment_list'][0], tuple)
+    process = master.process_with_controls if with_controls else master.process_without_controls
+    with open(os.path.join(job['results_dir'], 'log.txt'), 'w') as log, contextlib.redirect_stdout(log):
+        process(input_file, **job)
+    return job['results_dir']
+
+def run_batch(jobs, workers=None):
+    """Run jobs across a process pool and return the ones that failed"""
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                print(f"Finished {job['input_file']} -> {future.result()}")
+            except Exception:
+                print(f"Failed {job['input_file']}:\n{traceback.format_exc()}")
+                failed.append(job)
+    return failed
+
+def main():
+    """Main function to run the batch"""
+    parser = argparse.ArgumentParser(description='Process many MaxQuant runs from a manifest.')
+    parser.add_argument('manifest', help='Path to a JSON, TOML or YAML manifest')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (defaults to the number of CPUs)')
+    args = parser.parse_args()
+
+    manifest = read_manifest(args.manifest)
+    jobs = get_jobs(manifest, os.path.dirname(args.manifest))
+    print(f"Running {len(jobs)} jobs")
+    failed = run_batch(jobs, args.workers)
+
+    print(f"\nDone. {len(jobs) - len(failed)} of {len(jobs)} jobs succeeded.")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the sort_data_master pipeline stages
+
+Generates synthetic peptides.txt files (see synthetic_data.py), times each
+pipeline stage and measures its peak Python memory, and stores the results
+as JSON so they can be compared between versions:
+
+    python benchmark.py --rows 10000 1000000 --experiments 4 20
+    python benchmark.py --compare benchmarks/old.json benchmarks/new.json
+
+Stages are called the way the pipeline calls them, so the filter and
+aggregation timings include the stages they call internally.
+
+"""
+
+import os
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import sort_data_master as master
+import synthetic_data
+
+SIGNIFICANCE_THRESHOLD = 0.05
+MSMS_COUNT_THRESHOLD = 2
+
+# ===== STAGES =====
+
+def get_stages(experiment_list, with_controls, results_dir):
+    """List (name, function, input) for every benchmarked stage
+
+    Each function takes a fresh copy of its input DataFrame. Inputs are
+    named after the stage whose output they use.
+    """
+    thresholds = (SIGNIFICANCE_THRESHOLD, MSMS_COUNT_THRESHOLD)
+    log2fc_selection = '1/2' if len(experiment_list) > 1 else None
+    if with_controls:
+        return [
+            ('normalize_intensity', lambda data: master.normalize_intensity(experiment_list, data), 'convert_txt'),
+            ('filter_data_with_controls',
+             lambda data: master.filter_data_with_controls(experiment_list, data, *thresholds), 'convert_txt'),
+            ('combine_rows_with_controls',
+             lambda data: master.combine_rows_with_controls(experiment_list, data, *thresholds), 'convert_txt'),
+            ('remove_extra_columns_with_controls',
+             lambda data: master.remove_extra_columns_with_controls(experiment_list, data, *thresholds, results_dir),
+             'convert_txt'),
+            ('get_differentially_expressed',
+             lambda data: master.get_differentially_expressed(experiment_list, data, log2fc_selection, results_dir),
+             'remove_extra_columns_with_controls'),
+            ('get_experiment_exclusive',
+             lambda data: master.get_experiment_exclusive(experiment_list, data, 0, results_dir),
+             'remove_extra_columns_with_controls'),
+            ('get_all_exclusive',
+             lambda data: master.get_all_exclusive(experiment_list, data, results_dir=results_dir),
+             'remove_extra_columns_with_controls'),
+        ]
+    return [
+        ('filter_data_without_controls',
+         lambda data: master.filter_data_without_controls(experiment_list, data, *thresholds), 'convert_txt'),
+        ('combine_rows_without_controls',
+         lambda data: master.combine_rows_without_controls(experiment_list, data, *thresholds), 'convert_txt'),
+        ('remove_extra_columns_without_controls',
+         lambda data: master.remove_extra_columns_without_controls(experiment_list, data, *thresholds, results_dir),
+         'convert_txt'),
+        ('get_differentially_expressed',
+         lambda data: master.get_differentially_expressed(experiment_list, data, log2fc_selection, results_dir),
+         'remove_extra_columns_without_controls'),
+        ('get_experiment_exclusive',
+         lambda data: master.get_experiment_exclusive(experiment_list, data, 0, results_dir),
+         'remove_extra_columns_without_controls'),
+        ('get_all_exclusive',
+         lambda data: master.get_all_exclusive(experiment_list, data, results_dir=results_dir),
+         'remove_extra_columns_without_controls'),
+    ]
+
+def measure(function, make_input, repeat=3):
+    """Return the best wall time over repeat runs and the peak traced memory"""
+    seconds = []
+    for _ in range(repeat):
+        data = make_input()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            output = function(data)
+            seconds.append(time.perf_counter() - start)
+
+    data = make_input()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak, output
+
+def benchmark_dataset(peptides_txt, n_rows, n_experiments, with_controls, results_dir, repeat=3):
+    """Benchmark every stage on one synthetic dataset"""
+    experiment_list = synthetic_data.get_experiment_list(n_experiments, with_controls)
+    case = {'rows': n_rows, 'experiments': n_experiments, 'with_controls': with_controls}
+    results = []
+
+    seconds, peak, raw_data = measure(lambda path: master.convert_txt(path), lambda: peptides_txt, repeat)
+    results.append({**case, 'stage': 'convert_txt', 'seconds': seconds, 'peak_memory_mb': peak / 2 ** 20,
+                    'rows_out': len(raw_data)})
+    outputs = {'convert_txt': raw_data}
+
+    for name, function, source in get_stages(experiment_list, with_controls, results_dir):
+        seconds, peak, output = measure(function, lambda: outputs[source].copy(), repeat)
+        outputs[name] = output
+        rows_out = len(output) if isinstance(output, pd.DataFrame) else sum(len(frame) for frame in output.values())
+        results.append({**case, 'stage': name, 'seconds': seconds, 'peak_memory_mb': peak / 2 ** 20,
+                        'rows_in': len(outputs[source]), 'rows_out': rows_out})
+        print(f"  {name}: {seconds:.3f} s, {peak / 2 ** 20:.1f} MB")
+
+    return results
+
+# ===== REPORTING =====
+
+def get_environment():
+    """Describe the code version and environment the benchmark ran on"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+    }
+
+def compare(old_path, new_path):
+    """Print the time and memory ratio of each stage between two result files"""
+    with open(old_path) as handle:
+        old = json.load(handle)
+    with open(new_path) as handle:
+        new = json.load(handle)
+
+    def key(result):
+        return result['stage'], result['rows'], result['experiments'], result['with_controls']
+
+    baseline = {key(result): result for result in old['results']}
+    print(f"{'stage':40} {'rows':>9} {'exps':>5} {'ctrl':>5} {'time':>8} {'memory':>8}")
+    for result in new['results']:
+        previous = baseline.get(key(result))
+        if previous is None:
+            continue
+        print(f"{result['stage']:40} {result['rows']:>9} {result['experiments']:>5} {str(result['with_controls']):>5} "
+              f"{result['seconds'] / previous['seconds']:>7.2f}x "
+              f"{result['peak_memory_mb'] / max(previous['peak_memory_mb'], 1e-9):>7.2f}x")
+
+# ===== MAIN FUNCTIONS =====
+
+def main():
+    """Main function to run the benchmarks"""
+    parser = argparse.ArgumentParser(description='Benchmark the MaxQuant pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help='Numbers of peptides to benchmark (default: 10000)')
+    parser.add_argument('--experiments', type=int, nargs='+', default=[4],
+                        help='Numbers of samples to benchmark (default: 4)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing runs per stage; the best is kept (default: 3)')
+    parser.add_argument('--data-dir', default=None,
+                        help='Keep the synthetic peptides.txt files here instead of a temporary directory')
+    parser.add_argument('--output', default=None,
+                        help='Where to write the JSON results (default: benchmarks/<timestamp>_<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two result files instead of running the benchmarks')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    environment = get_environment()
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        data_dir = args.data_dir or scratch
+        os.makedirs(data_dir, exist_ok=True)
+        for n_rows in args.rows:
+            for n_experiments in args.experiments:
+                peptides_txt = os.path.join(data_dir, f'peptides_{n_rows}_{n_experiments}.txt')
+                if not os.path.exists(peptides_txt):
+                    print(f"Generating {n_rows} peptides with {n_experiments} samples")
+                    synthetic_data.generate_peptides(peptides_txt, n_rows, n_experiments)
+                for with_controls in (True, False):
+                    print(f"Benchmarking {n_rows} peptides, {n_experiments} samples, "
+                          f"{'with' if with_controls else 'without'} controls")
+                    results.extend(benchmark_dataset(
+                        peptides_txt, n_rows, n_experiments, with_controls, scratch, args.repeat
+                    ))
+
+    output = args.output or os.path.join(
+        'benchmarks', f"{environment['timestamp'].replace(':', '')}_{environment['commit'] or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump({'environment': environment, 'results': results}, handle, indent=2)
+    print(f"\nDone. Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Dense intensity and count matrices
+
+An ExperimentMatrix holds the per-sample intensities and counts of a peptide
+or protein table as contiguous N x E float arrays, together with the protein
+of every row. Control subtraction, missing count handling and sample normalization
+are whole-matrix operations on it, and DataFrame columns are only built
+again, all at once, when results are put back into a table.
+
+"""
+
+import warnings
+import numpy as np
+import pandas as pd
+
+# Between-sample normalization methods of ExperimentMatrix.normalize_samples
+NORMALIZATIONS = ('median', 'total', 'quantile')
+
+def quantile_normalize(values):
+    """Give every column of values the same distribution, ignoring NaNs
+
+    Each column is sorted once. The reference distribution is the mean of
+    the columns' quantile functions on a common grid, which is the classic
+    rank mean when no values are missing, and every value is replaced by
+    the reference at its rank.
+    """
+    n_rows = values.shape[0]
+    counts = (~np.isnan(values)).sum(axis=0)
+    size = int(counts.max(initial=0))
+    if size == 0:
+        return values.copy()
+    order = np.argsort(values, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=0)
+
+    last = np.maximum(counts - 1, 0)
+    position = np.linspace(0, 1, size)[:, None] * last
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, last)
+    fraction = position - low
+    quantiles = np.take_along_axis(sorted_values, low, axis=0) * (1 - fraction) + \
+        np.take_along_axis(sorted_values, high, axis=0) * fraction
+    quantiles[:, counts == 0] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        reference = np.nanmean(quantiles, axis=1)
+
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(n_rows)[:, None], axis=0)
+    position = np.minimum(ranks * ((size - 1) / np.maximum(last, 1)), size - 1)
+    low = np.floor(position).astype(np.int64)
+    fraction = position - low
+    normalized = reference[low] * (1 - fraction) + reference[np.minimum(low + 1, size - 1)] * fraction
+    return np.where(np.isnan(values), np.nan, normalized)
+
+class ExperimentMatrix:
+    """N x E intensity and count matrices with the protein of every row"""
+
+    def __init__(self, names, intensity, count, proteins=None):
+        self.names = list(names)
+        self.intensity = intensity
+        self.count = count
+        self.proteins = proteins
+
+    @classmethod
+    def from_frame(cls, experimental_data, names, intensity_prefix='Intensity ', count_prefix='Experiment ',
+                   key='Protein names'):
+        """Read the intensity and count columns of the given samples
+
+        Missing counts become zeros, since MaxQuant leaves them empty when a
+        peptide was not seen in a sample. Missing intensities are kept.
+        """
+        intensity = experimental_data[[f'{intensity_prefix}{name}' for name in names]].to_numpy(dtype=np.float64)
+        count = experimental_data[[f'{count_prefix}{name}' for name in names]].to_numpy(dtype=np.float64)
+        np.nan_to_num(count, copy=False, nan=0.0)
+        proteins = experimental_data[key] if key in experimental_data.columns else None
+        return cls(names, intensity, count, proteins)
+
+    def __len__(self):
+        return self.intensity.shape[0]
+
+    def subtract_controls(self, experiment_list):
+        """Matrix of the experiments with their control's intensity and count subtracted"""
+        experiments = [self.names.index(experiment) for experiment, _ in experiment_list]
+        controls = [self.names.index(control) for _, control in experiment_list]
+        return ExperimentMatrix(
+            [experiment for experiment, _ in experiment_list],
+            self.intensity[:, experiments] - self.intensity[:, controls],
+            self.count[:, experiments] - self.count[:, controls],
+            self.proteins,
+        )
+
+    def normalize_samples(self, method, rows=None):
+        """Matrix with the sample intensities made comparable to each other
+
+        'median' and 'total' scale every sample so that its median or total
+        intensity matches the others (the geometric mean of the medians, the
+        mean of the totals). 'quantile' gives every sample the same intensity
+        distribution. The statistics are taken over rows (a boolean mask, all
+        rows if None), and with 'quantile' only those rows are changed.
+        Intensities of zero or less count as missing and are kept as they are.
+        """
+        if method not in NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization {method!r}; choose from {', '.join(NORMALIZATIONS)}")
+        fitted = self.intensity if rows is None else self.intensity[rows]
+        observed = np.where(fitted > 0, fitted, np.nan)
+
+        if method == 'quantile':
+            intensity = self.intensity.copy()
+            normalized = quantile_normalize(observed)
+            if rows is None:
+                intensity = np.where(fitted > 0, normalized, intensity)
+            else:
+                intensity[rows] = np.where(fitted > 0, normalized, fitted)
+            return ExperimentMatrix(self.names, intensity, self.count, self.proteins)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if method == 'median':
+                level = np.nanmedian(observed, axis=0)
+                target = np.exp2(np.nanmean(np.log2(level)))
+            else:
+                level = np.nansum(observed, axis=0)
+                level[level == 0] = np.nan
+                target = np.nanmean(level)
+        factors = np.where(np.isfinite(level), target / level, 1.0)
+        return ExperimentMatrix(self.names, self.intensity * factors, self.count, self.proteins)
+
+    def to_frame(self, intensity_prefix, count_prefix, count_first=False, dtypes=None, index=None):
+        """Build the intensity and count columns of every sample, side by side
+
+        dtypes maps column names to the dtype each column is cast back to;
+        the others stay float64. Counts are left out if count_prefix is None.
+        """
+        dtypes = dtypes or {}
+        columns = {}
+        for i, name in enumerate(self.names):
+            pair = [(f'{intensity_prefix}{name}', self.intensity[:, i])]
+            if count_prefix is not None:
+                pair.append((f'{count_prefix}{name}', self.count[:, i]))
+            for column, values in (pair[::-1] if count_first else pair):
+                columns[column] = values.astype(dtypes.get(column, np.float64), copy=False)
+        return pd.DataFrame(columns, index=index)
+
+def append_columns(experimental_data, columns):
+    """Add a block of columns to a table in one step, replacing any of the same name"""
+    existing = [column for column in columns.columns if column in experimental_data.columns]
+    if existing:
+        experimental_data = experimental_data.drop(columns=existing)
+    return pd.concat([experimental_data, columns], axis=1, copy=False)
+
+def replace_columns(experimental_data, columns):
+    """Return a table with some of its columns replaced, built in one step"""
+    return pd.DataFrame({
+        name: columns[name] if name in columns.columns else experimental_data[name]
+        for name in experimental_data.columns
+    }, index=experimental_data.index)
@@ -0,0 +1,103 @@
+"""
+Missing intensity imputation
+
+Intensities of zero or less count as missing and are imputed on log2 scale,
+for all proteins and experiments at once, with one of:
+
+- 'normal': draws from a normal distribution shifted down from each
+  experiment's observed intensities (the Perseus defaults: 1.8 standard
+  deviations down, 0.3 standard deviations wide), standing in for proteins
+  below the detection limit;
+- 'min': each experiment's smallest observed intensity;
+- 'knn': the mean of the k nearest proteins that were observed in every
+  experiment.
+
+Random draws come from a generator seeded with seed, so runs are
+reproducible.
+
+"""
+
+import warnings
+import numpy as np
+
+IMPUTATIONS = ('normal', 'min', 'knn')
+
+# ===== METHODS =====
+
+def impute_normal(log_intensity, rng, shift=1.8, width=0.3):
+    """Fill missing values with down-shifted normal draws per experiment"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(log_intensity, axis=0)
+        std = np.nanstd(log_intensity, axis=0, ddof=1)
+    draws = rng.standard_normal(log_intensity.shape) * (width * std) + (mean - shift * std)
+    return np.where(np.isnan(log_intensity), draws, log_intensity)
+
+def impute_min(log_intensity):
+    """Fill missing values with each experiment's smallest observed value"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        minimum = np.nanmin(log_intensity, axis=0)
+    return np.where(np.isnan(log_intensity), minimum, log_intensity)
+
+def impute_knn(log_intensity, rng, neighbors=10, max_donors=10000, block_size=1 << 23):
+    """Fill missing values with the mean of the nearest complete proteins
+
+    Neighbours are drawn from the proteins observed in every experiment,
+    subsampled to max_donors, so the cost grows linearly with the number of
+    proteins. The distance is the mean squared difference over the
+    experiments a protein was observed in. Proteins with missing values are
+    handled in blocks of about block_size distances; those observed nowhere
+    get the mean of all donors.
+    """
+    missing = np.isnan(log_intensity)
+    queries = np.flatnonzero(missing.any(axis=1))
+    donors = np.flatnonzero(~missing.any(axis=1))
+    if len(queries) == 0:
+        return log_intensity.copy()
+    if len(donors) == 0:
+        print("No protein is observed in every experiment; imputing the minimum instead of kNN")
+        return impute_min(log_intensity)
+    if len(donors) > max_donors:
+        donors = np.sort(rng.choice(donors, max_donors, replace=False))
+
+    donor_values = log_intensity[donors]
+    donor_squares = (donor_values ** 2).T
+    k = min(neighbors, len(donors))
+    result = log_intensity.copy()
+    rows = max(1, block_size // len(donors))
+    for start in range(0, len(queries), rows):
+        block = queries[start:start + rows]
+        observed = ~missing[block]
+        values = np.where(observed, log_intensity[block], 0.0)
+        shared = observed.sum(axis=1, keepdims=True)
+        squared = (values ** 2).sum(axis=1, keepdims=True) - 2 * values @ donor_values.T + observed @ donor_squares
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.where(shared > 0, squared / shared, np.inf)
+        nearest = np.argpartition(distance, k - 1, axis=1)[:, :k]
+        estimate = np.where(shared > 0, donor_values[nearest].mean(axis=1), donor_values.mean(axis=0))
+        result[block] = np.where(observed, log_intensity[block], estimate)
+    return result
+
+# ===== IMPUTATION STAGE =====
+
+def impute(intensity, method, seed=0, neighbors=10):
+    """Impute the missing values of a proteins x experiments intensity matrix
+
+    Returns the imputed matrix and a boolean matrix of the imputed cells.
+    Experiments without any observed intensity are left as they are.
+    """
+    if method not in IMPUTATIONS:
+        raise ValueError(f"Unknown imputation {method!r}; choose from {', '.join(IMPUTATIONS)}")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_intensity = np.where(intensity > 0, np.log2(intensity), np.nan)
+    rng = np.random.default_rng(seed)
+    if method == 'normal':
+        imputed_log = impute_normal(log_intensity, rng)
+    elif method == 'min':
+        imputed_log = impute_min(log_intensity)
+    else:
+        imputed_log = impute_knn(log_intensity, rng, neighbors)
+
+    imputed = np.isnan(log_intensity) & np.isfinite(imputed_log)
+    return np.where(imputed, np.exp2(imputed_log), intensity), imputed
@@ -0,0 +1,398 @@
+"""
+Readers for MaxQuant output tables
+
+"""
+
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CACHE_DIR = "experimental_data/cache"
+
+# External decompressors to try for each compressed extension, in order.
+# They run as separate processes, so decompression overlaps with parsing.
+DECOMPRESSORS = {
+    '.gz': [['pigz', '-dc'], ['gzip', '-dc']],
+    '.zst': [['zstd', '-dcq']],
+    '.zstd': [['zstd', '-dcq']],
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    '.xz': [['xz', '-dc', '-T0']],
+}
+
+# evidence.txt columns used for the peptide rollup, by lower-case name since
+# MaxQuant versions disagree on capitalization (e.g. 'MS/MS count')
+EVIDENCE_COLUMNS = {
+    'peptide id': 'Peptide ID', 'sequence': 'Sequence', 'proteins': 'Proteins',
+    'leading razor protein': 'Leading razor protein', 'gene names': 'Gene names',
+    'protein names': 'Protein names', 'experiment': 'Experiment', 'raw file': 'Raw file',
+    'pep': 'PEP', 'ms/ms count': 'MS/MS Count', 'intensity': 'Intensity',
+    'potential contaminant': 'Potential contaminant', 'reverse': 'Reverse',
+}
+
+# Formats the aggregated table can be saved in, as aggregated_data.<format>
+AGGREGATED_FORMATS = ('csv', 'arrow', 'parquet')
+
+# Peptide-level columns taken from the peptide's evidences: the first non-empty
+# value, or for the 'Potential contaminant' and 'Reverse' flags, any flagged one
+EVIDENCE_PEPTIDE_COLUMNS = [
+    'Sequence', 'Proteins', 'Leading razor protein', 'Gene names', 'Protein names',
+    'Potential contaminant', 'Reverse',
+]
+
+# ===== READ-TIME SCHEMA =====
+
+def get_sample_names(experiment_list):
+    """List every experiment and control name once, in input order"""
+    names = []
+    for entry in experiment_list:
+        for name in (entry if isinstance(entry, tuple) else (entry,)):
+            if name not in names:
+                names.append(name)
+    return names
+
+def get_required_columns(experiment_list):
+    """Columns of peptides.txt needed to analyse the given experiments"""
+    columns = ['Protein names', 'PEP', 'MS/MS Count', 'Potential contaminant']
+    for name in get_sample_names(experiment_list):
+        columns.extend([f'Intensity {name}', f'Experiment {name}'])
+    return columns
+
+def discover_experiments(columns):
+    """Experiments with both an 'Intensity X' and an 'Experiment X' column, in header order"""
+    column_set = set(columns)
+    names = [column[len('Intensity '):] for column in columns if column.startswith('Intensity ')]
+    return [name for name in names if f'Experiment {name}' in column_set]
+
+def check_experiments(experiment_list, columns):
+    """Check that a header has every column needed to analyse experiment_list
+
+    Raises ValueError naming the unknown experiments or missing columns,
+    together with the experiments the header does have.
+    """
+    column_set = set(columns)
+    missing = [column for column in get_required_columns(experiment_list) if column not in column_set]
+    if not missing:
+        return
+    available = discover_experiments(columns)
+    unknown = [name for name in get_sample_names(experiment_list) if name not in available]
+    if unknown:
+        problem = f"Unknown experiments: {', '.join(unknown)}"
+    else:
+        problem = f"Missing columns: {', '.join(missing)}"
+    raise ValueError(f"{problem}. Experiments in the input file: {', '.join(available) or 'none'}")
+
+def check_log2fc_selection(selection, experiments):
+    """Check that selection names two of the experiments, as in '1/2'"""
+    if selection is None:
+        raise ValueError("'log2fc_selection' is required with more than one experiment")
+    first, separator, second = str(selection).partition('/')
+    if not (separator and first.isdigit() and second.isdigit()
+            and 1 <= int(first) <= experiments and 1 <= int(second) <= experiments):
+        raise ValueError(f"'log2fc_selection' must be two experiment numbers from 1 to {experiments}, as in '1/2'; "
+                         f"got {selection!r}")
+
+def compact_dtypes(experimental_data):
+    """Shrink a projected peptides table to compact dtypes
+
+    Protein names become categorical, intensities become float32 when every
+    value survives the round trip exactly, and counts become the smallest
+    integer type that holds them. Missing 'Experiment' counts are replaced
+    with zeros, as the pipeline does before using them.
+    """
+    for column in experimental_data.columns:
+        values = experimental_data[column]
+        if column.startswith('Intensity '):
+            narrow = values.astype(np.float32)
+            if ((narrow.astype(np.float64) == values) | values.isna()).all():
+                experimental_data[column] = narrow
+        elif column.startswith('Experiment ') or column == 'MS/MS Count':
+            experimental_data[column] = pd.to_numeric(values.fillna(0), downcast='integer')
+    experimental_data['Protein names'] = experimental_data['Protein names'].astype('category')
+    return experimental_data
+
+# ===== INPUT =====
+
+@contextlib.contextmanager
+def open_input(experimental_data_txt):
+    """Open a MaxQuant table, which may be compressed, for pandas to read
+
+    Compressed files are streamed through pigz, zstd, lbzip2 or xz when one
+    is installed, so the file is never expanded on disk and decompression
+    runs on other cores while pandas parses. Otherwise the path is passed
+    through and pandas decompresses it itself, as it does for plain files;
+    .zstd files, which pandas does not recognize, are opened with the
+    zstandard package pandas would use.
+    """
+    extension = os.path.splitext(experimental_data_txt)[1].lower()
+    command = next((command for command in DECOMPRESSORS.get(extension, []) if shutil.which(command[0])), None)
+    if command is None and extension == '.zstd':
+        if zstandard is None:
+            raise ImportError("Reading .zstd files requires the zstd command or the zstandard package")
+        with zstandard.open(experimental_data_txt, 'rb') as source:
+            yield source
+        return
+    if command is None:
+        yield experimental_data_txt
+        return
+
+    process = subprocess.Popen(command + [experimental_data_txt], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield process.stdout
+    finally:
+        # Closing early (e.g. after reading the header) stops the decompressor with SIGPIPE
+        process.stdout.close()
+        error = process.stderr.read().decode(errors='replace').strip()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode > 0:
+        raise OSError(f"{command[0]} could not decompress {experimental_data_txt}: {error}")
+
+def read_header(experimental_data_txt):
+    """Read only the column names of a MaxQuant table"""
+    with open_input(experimental_data_txt) as source:
+        return pd.read_csv(source, delimiter="\t", nrows=0).columns
+
+def iter_chunks(experimental_data_txt, columns=None, cache_dir=None, chunksize=100000, dtype=None):
+    """Yield a MaxQuant table in chunks, from the binary cache if cache_dir is given"""
+    if cache_dir:
+        yield from iter_cached_chunks(experimental_data_txt, columns, cache_dir, chunksize)
+        return
+    with open_input(experimental_data_txt) as source:
+        yield from pd.read_csv(source, delimiter="\t", chunksize=chunksize, usecols=columns, dtype=dtype)
+
+# ===== FILTERS =====
+
+def filter_peptides(experimental_data, significance_threshold, msms_count_threshold):
+    """Keep peptides that pass the PEP, MS/MS count and contaminant filters"""
+    return experimental_data[
+        (experimental_data['MS/MS Count'] >= msms_count_threshold) &
+        (experimental_data['PEP'] <= significance_threshold) &
+        (experimental_data['Potential contaminant'].isna())
+    ]
+
+# ===== BINARY CACHE =====
+
+def hash_file(path, block_size=1 << 23):
+    """Hash the contents of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_cache_path(experimental_data_txt, cache_dir=CACHE_DIR):
+    """Locate the cache entry for a file, keyed by its content hash
+
+    The hash of each input is remembered together with its size and mtime in
+    an index, so unchanged files are not re-hashed on every run.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as handle:
+            index = json.load(handle)
+
+    stat = os.stat(experimental_data_txt)
+    source = os.path.abspath(experimental_data_txt)
+    entry = index.get(source)
+    if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hash_file(experimental_data_txt)}
+        index[source] = entry
+        # Write atomically, since parallel batch jobs may share the cache
+        staging_path = f"{index_path}.tmp{os.getpid()}"
+        with open(staging_path, 'w') as handle:
+            json.dump(index, handle, indent=2)
+        os.replace(staging_path, index_path)
+
+    return os.path.join(cache_dir, entry['hash'])
+
+def build_cache(experimental_data_txt, cache_path, chunksize=100000):
+    """Parse a MaxQuant table once and store it as Parquet parts"""
+    print(f"Caching parsed {os.path.basename(experimental_data_txt)}")
+    staging_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(staging_path, exist_ok=True)
+    for part, chunk in enumerate(iter_chunks(experimental_data_txt, chunksize=chunksize)):
+        chunk.to_parquet(os.path.join(staging_path, f'part-{part:05d}.parquet'))
+    try:
+        os.rename(staging_path, cache_path)
+    except OSError:
+        # Another run finished the same cache entry first
+        shutil.rmtree(staging_path)
+
+def iter_cached_chunks(experimental_data_txt, columns=None, cache_dir=CACHE_DIR, chunksize=100000):
+    """Yield peptides.txt in chunks from its Parquet cache, building it if needed"""
+    cache_path = get_cache_path(experimental_data_txt, cache_dir)
+    if not os.path.isdir(cache_path):
+        build_cache(experimental_data_txt, cache_path, chunksize)
+    for part in sorted(glob.glob(os.path.join(cache_path, 'part-*.parquet'))):
+        yield pd.read_parquet(part, columns=columns)
+
+# ===== READERS =====
+
+def read_peptides(experimental_data_txt, columns=None, cache_dir=None):
+    """Read peptides.txt into memory
+
+    If columns is given, only those columns are parsed and they are stored
+    with compact dtypes. If cache_dir is given, the parsed table is loaded
+    from (or saved to) the binary cache there.
+    """
+    if cache_dir:
+        experimental_data = pd.concat(iter_cached_chunks(experimental_data_txt, columns, cache_dir))
+    else:
+        with open_input(experimental_data_txt) as source:
+            experimental_data = pd.read_csv(source, delimiter="\t", usecols=columns)
+    if columns is not None:
+        experimental_data = compact_dtypes(experimental_data)
+    return experimental_data
+
+def read_peptides_chunked(experimental_data_txt, significance_threshold, msms_count_threshold, chunksize=100000,
+                          columns=None, cache_dir=None):
+    """Stream peptides.txt in chunks, keeping only rows that pass the filters
+
+    Peak memory is bounded by the chunk size plus the surviving rows rather
+    than by the size of the file.
+    """
+    chunks = [
+        filter_peptides(chunk, significance_threshold, msms_count_threshold)
+        for chunk in iter_chunks(experimental_data_txt, columns, cache_dir, chunksize)
+    ]
+    if not chunks:
+        with open_input(experimental_data_txt) as source:
+            chunks = [pd.read_csv(source, delimiter="\t", nrows=0, usecols=columns)]
+    experimental_data = pd.concat(chunks)
+    if columns is not None:
+        experimental_data = compact_dtypes(experimental_data)
+    return experimental_data
+
+# ===== EVIDENCE =====
+
+def get_evidence_columns(evidence_txt):
+    """Map the evidence.txt header onto the canonical column names"""
+    header = read_header(evidence_txt)
+    columns = {
+        column: EVIDENCE_COLUMNS[column.strip().lower()]
+        for column in header if column.strip().lower() in EVIDENCE_COLUMNS
+    }
+    missing = {'Protein names', 'PEP', 'MS/MS Count', 'Intensity'} - set(columns.values())
+    if 'Peptide ID' not in columns.values() and 'Sequence' not in columns.values():
+        missing.add('Peptide ID')
+    if 'Experiment' not in columns.values() and 'Raw file' not in columns.values():
+        missing.add('Experiment')
+    if missing:
+        raise ValueError(f"{evidence_txt} is missing the evidence columns {sorted(missing)}")
+    return columns
+
+def combine_evidence_partials(partials):
+    """Merge partial (peptide, experiment) rollups of different chunks"""
+    return pd.concat(partials).groupby(level=[0, 1], sort=False).agg(
+        {'Intensity': 'sum', 'Evidence': 'sum', 'PEP': 'min', 'MS/MS Count': 'sum'}
+    )
+
+def read_evidence(evidence_txt, chunksize=100000, cache_dir=None, combine_every=16):
+    """Stream evidence.txt and roll it up into a peptides.txt-style table
+
+    Evidence rows are summed per peptide and experiment as they are read:
+    'Intensity X' is the summed intensity and 'Experiment X' the number of
+    evidences in experiment X (empty when there are none, as in
+    peptides.txt). PEP is the peptide's best PEP and MS/MS Count its total
+    MS/MS count over all experiments. Experiments are taken from the
+    Experiment column, or from Raw file when there is none, in the order
+    they first appear. A peptide is flagged as 'Potential contaminant' or
+    'Reverse' when any of its evidences is (the column is left empty if
+    evidence.txt has none); its other columns take their first non-empty
+    value in file order. Only the partial rollups are held in memory, never
+    the evidence table itself.
+    """
+    columns = get_evidence_columns(evidence_txt)
+    names = set(columns.values())
+    peptide_key = 'Peptide ID' if 'Peptide ID' in names else 'Sequence'
+    experiment_key = 'Experiment' if 'Experiment' in names else 'Raw file'
+    peptide_columns = [column for column in EVIDENCE_PEPTIDE_COLUMNS if column in names and column != peptide_key]
+    original = {name: column for column, name in columns.items()}
+    flags = [column for column in ('Potential contaminant', 'Reverse') if column in peptide_columns]
+    peptide_agg = {column: 'max' if column in flags else 'first' for column in peptide_columns}
+
+    reader = iter_chunks(evidence_txt, list(columns), cache_dir, chunksize, dtype={original[experiment_key]: str})
+
+    partials, firsts = [], []
+    for chunk in reader:
+        chunk = chunk.rename(columns=columns)
+        chunk[experiment_key] = chunk[experiment_key].astype(str)
+        chunk[flags] = chunk[flags].notna()
+        partials.append(chunk.groupby([peptide_key, experiment_key], sort=False).agg(
+            Intensity=('Intensity', 'sum'), Evidence=('Intensity', 'size'),
+            PEP=('PEP', 'min'), **{'MS/MS Count': ('MS/MS Count', 'sum')}
+        ))
+        firsts.append(chunk.groupby(peptide_key, sort=False)[peptide_columns].agg(peptide_agg))
+        if len(partials) >= combine_every:
+            partials = [combine_evidence_partials(partials)]
+            firsts = [pd.concat(firsts).groupby(level=0, sort=False).agg(peptide_agg)]
+
+    rollup = combine_evidence_partials(partials)
+    peptides = pd.concat(firsts).groupby(level=0).agg(peptide_agg)
+    for column in flags:
+        peptides[column] = pd.Series('+', index=peptides.index, dtype=object).where(peptides[column])
+    if 'Potential contaminant' not in flags:
+        peptides['Potential contaminant'] = np.nan
+        flags = ['Potential contaminant'] + flags
+    statistics = rollup.groupby(level=0).agg({'PEP': 'min', 'MS/MS Count': 'sum'})
+    intensity = rollup['Intensity'].unstack(experiment_key, fill_value=0.0)
+    evidence = rollup['Evidence'].unstack(experiment_key)
+    experiments = list(pd.unique(rollup.index.get_level_values(experiment_key)))
+
+    experimental_data = pd.concat([
+        peptides[[column for column in peptide_columns if column not in flags]],
+        statistics,
+        evidence[experiments].add_prefix('Experiment '),
+        intensity[experiments].add_prefix('Intensity '),
+        peptides[flags],
+    ], axis=1)
+    experimental_data.index.name = 'id' if peptide_key == 'Peptide ID' else 'Sequence'
+    print(f"Rolled up {len(experimental_data)} peptides in {len(experiments)} experiments from evidence.txt")
+    return experimental_data.reset_index()
+
+# ===== AGGREGATED RESULTS =====
+
+def get_aggregated_path(results_dir="results"):
+    """Path of the most recently saved aggregated table in results_dir, in any format"""
+    paths = [os.path.join(results_dir, f"aggregated_data.{file_format}") for file_format in AGGREGATED_FORMATS]
+    existing = [path for path in paths if os.path.exists(path)]
+    if not existing:
+        raise FileNotFoundError(f"No aggregated_data table in {results_dir}")
+    return max(existing, key=os.path.getmtime)
+
+def load_aggregated(source):
+    """Aggregated table from a DataFrame, or from a .csv, .arrow or .parquet file
+
+    Arrow files are memory-mapped, and numeric columns without missing
+    values are used in place rather than copied, so even large tables open
+    at once. Those columns are read-only.
+    """
+    if isinstance(source, pd.DataFrame):
+        return source
+    extension = os.path.splitext(source)[1].lower()
+    if extension in ('.arrow', '.feather'):
+        if pa is None:
+            raise ImportError("Reading Arrow files requires pyarrow")
+        table = pa.ipc.open_file(pa.memory_map(source)).read_all()
+        return table.to_pandas(split_blocks=True)
+    if extension == '.parquet':
+        return pd.read_parquet(source, memory_map=True)
+    return pd.read_csv(source)
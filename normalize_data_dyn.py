@@ -1,14 +1,12 @@
 # Import Modules
-import numpy as np
-import pandas as pd
 import common_data as common
+import aggregation
+import load_data
 
-# Read raw data and convert from .txt to .csv
+# Read raw data from peptides.txt
 def convert_txt(experimental_data_txt):
-    print("Converting peptides.txt into a .csv")
-    experimental_data = pd.read_csv(experimental_data_txt, delimiter="\t")
-    experimental_data.to_csv("experimental_data/peptides.csv", index=False)
-    return experimental_data
+    print("Reading peptides.txt")
+    return load_data.read_peptides(experimental_data_txt)
 
 # User inputs dynamic number of experiment/control pairs
 # These should match experiment names defined in mqpar.xml
@@ -76,8 +74,7 @@ def filter_data(experiment_list, experimental_data):
 def combine_rows(experiment_list, experimental_data):
     print('Aggregating rows by protein name')
     experimental_data = filter_data(experiment_list, experimental_data)
-    grouped_data = experimental_data.groupby('Protein names').agg(lambda x: x.sum() if np.issubdtype(x.dtype, np.number) else x.iloc[0])
-    grouped_data.reset_index(inplace=True)
+    grouped_data = aggregation.aggregate_by_protein(experimental_data)
 
     return grouped_data
 
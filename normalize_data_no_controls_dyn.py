@@ -1,7 +1,7 @@
-import numpy as np
 import pandas as pd
 import normalize_data_dyn as norm
 import common_data as common
+import aggregation
 
 # Script for cleaning MaxQuant data containing experiments w/o corresponding controls
 # 1. Get a list of experiments from the user
@@ -54,8 +54,7 @@ def filter_data(experiment_list, experimental_data):
 def group_rows(experiment_list, experimental_data):
     print("Aggregating rows by protein name")
     experimental_data = filter_data(experiment_list, experimental_data)
-    grouped_data = experimental_data.groupby('Protein names').agg(lambda x: x.sum() if np.issubdtype(x.dtype, np.number) else x.iloc[0])
-    grouped_data.reset_index(inplace=True)
+    grouped_data = aggregation.aggregate_by_protein(experimental_data)
 
     return grouped_data
 
@@ -0,0 +1,217 @@
+"""
+Memoized stage graph for the MaxQuant pipeline
+
+The processing chain of sort_data_master is expressed as named stages with
+explicit dependencies. Every result is memoized under a key built from the
+stage's own settings and the keys of the stages it depends on, so asking for
+a stage again with different settings only recomputes what those settings
+affect: a new PEP threshold reuses the normalized peptides (unless samples
+are normalized against each other, which depends on it), and a new fold
+change pair reuses the aggregated table.
+
+    stages = pipeline.build_pipeline()
+    settings = dict(input_file='peptides.txt', experiment_list=[('A', 'B')],
+                    significance_threshold=0.05, msms_count_threshold=2)
+    aggregated = stages.get('aggregated', **settings)
+    stages.get('differential', **settings, log2fc_selection='1/2')
+
+Results are shared between callers and must not be modified in place.
+With max_bytes, the least recently used results are dropped from memory
+once they take up more than that.
+
+"""
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import collections
+import numpy as np
+import pandas as pd
+import aggregation
+import sort_data_master as master
+
+# ===== STAGE GRAPH =====
+
+def get_size(result):
+    """Approximate memory taken by a stage result, in bytes"""
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(np.sum(result.memory_usage(deep=True)))
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(get_size(value) for value in result.values())
+    return sys.getsizeof(result)
+
+class Pipeline:
+    """Dependency graph of stages whose results are memoized by their inputs
+
+    With spill_dir, results are also pickled there, so they survive the
+    process and are reloaded instead of recomputed. With max_bytes, results
+    are evicted least recently used first to keep the memoized results
+    under that size; the latest result is always kept, and results of
+    pinned stages are neither evicted nor counted.
+    """
+
+    def __init__(self, spill_dir=None, max_bytes=None):
+        self.stages = {}
+        self.results = collections.OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+
+    def add_stage(self, name, function, deps=(), params=(), key=None):
+        """Register a stage
+
+        function is called with the results of deps followed by params as
+        keyword arguments taken from the settings. key, if given, maps the
+        settings to what identifies the stage's inputs instead of params.
+        """
+        self.stages[name] = {'function': function, 'deps': tuple(deps), 'params': tuple(params), 'key': key}
+
+    def pin(self, name):
+        """Keep every result of a stage in memory, whatever max_bytes"""
+        self.pinned.add(name)
+
+    def get_key(self, name, settings):
+        """Hash a stage's settings together with the keys of its dependencies"""
+        stage = self.stages[name]
+        if stage['key'] is not None:
+            own = stage['key'](settings)
+        else:
+            own = [settings.get(param) for param in stage['params']]
+        deps = [self.get_key(dep, settings) for dep in stage['deps']]
+        payload = json.dumps([name, own, deps], default=str)
+        return f"{name}-{hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()}"
+
+    def get(self, name, **settings):
+        """Return a stage's result, computing only the stages not memoized yet"""
+        key = self.get_key(name, settings)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        spill_path = os.path.join(self.spill_dir, f"{key}.pkl") if self.spill_dir else None
+        if spill_path and os.path.exists(spill_path):
+            with open(spill_path, 'rb') as handle:
+                result = pickle.load(handle)
+        else:
+            stage = self.stages[name]
+            inputs = [self.get(dep, **settings) for dep in stage['deps']]
+            result = stage['function'](*inputs, **{param: settings.get(param) for param in stage['params']})
+            if spill_path:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(f"{spill_path}.tmp", 'wb') as handle:
+                    pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{spill_path}.tmp", spill_path)
+
+        self.remember(key, result, name in self.pinned)
+        return result
+
+    def remember(self, key, result, pinned=False):
+        """Memoize a result, evicting the least recently used ones beyond max_bytes"""
+        self.results[key] = result
+        if self.max_bytes is None or pinned:
+            return
+        self.sizes[key] = get_size(result)
+        while self.get_memory_usage() > self.max_bytes:
+            evicted = next((other for other in self.results if other in self.sizes and other != key), None)
+            if evicted is None:
+                break
+            del self.results[evicted], self.sizes[evicted]
+
+    def get_memory_usage(self):
+        """Approximate size of the memoized results, in bytes"""
+        return sum(self.sizes.values())
+
+    def clear(self):
+        """Forget the results held in memory"""
+        self.results.clear()
+        self.sizes.clear()
+
+# ===== STAGES =====
+
+def get_input_key(settings):
+    """Identify the peptides.txt contents and how it is parsed"""
+    stat = os.stat(settings['input_file'])
+    return [
+        os.path.abspath(settings['input_file']), stat.st_size, stat.st_mtime_ns,
+        settings.get('compact'), settings.get('cache'), settings.get('evidence'),
+        # Compact parsing only reads the columns of the selected experiments
+        settings.get('experiment_list') if settings.get('compact') else None,
+    ]
+
+def load_peptides(input_file, experiment_list=None, compact=False, cache=False, evidence=False):
+    """Read peptides.txt, or roll up evidence.txt"""
+    return master.convert_txt(input_file, experiment_list=experiment_list, compact=bool(compact), cache=bool(cache),
+                              evidence=bool(evidence))
+
+def get_normalized_key(settings):
+    """Identify the normalization; the thresholds only matter when samples are normalized"""
+    normalization = settings.get('normalization')
+    thresholds = [settings.get('significance_threshold'), settings.get('msms_count_threshold')] if normalization else None
+    return [settings.get('experiment_list'), normalization, thresholds]
+
+def normalize_peptides(peptides, experiment_list, normalization=None, significance_threshold=None,
+                       msms_count_threshold=None):
+    """Normalize the samples if asked, then subtract controls
+
+    Peptides without controls are otherwise used as they are.
+    """
+    if normalization:
+        rows = master.get_threshold_mask(peptides, significance_threshold, msms_count_threshold)
+        peptides = master.normalize_samples(experiment_list, peptides, normalization, rows)
+    if isinstance(experiment_list[0], tuple):
+        return master.normalize_intensity(experiment_list, peptides)
+    return peptides
+
+def filter_peptides(normalized, experiment_list, significance_threshold, msms_count_threshold):
+    """Row mask of the PEP, MS/MS count, contaminant and empty-row filters"""
+    return master.get_row_mask(experiment_list, normalized, significance_threshold, msms_count_threshold)
+
+def aggregate_peptides(normalized, filtered, experiment_list):
+    """Sum the kept peptides by protein and drop the columns the analyses do not use"""
+    aggregated = aggregation.aggregate_by_protein(normalized, mask=filtered)
+    return aggregated.drop(columns=master.get_columns_to_drop(experiment_list, aggregated.columns))
+
+def impute_proteins(aggregated, experiment_list, impute=None, seed=0):
+    """Impute missing protein intensities if asked"""
+    if impute:
+        return master.impute_missing(experiment_list, aggregated, impute, seed or 0)
+    return aggregated
+
+def get_differential(aggregated, experiment_list, log2fc_selection, replicates=None, moderated=False):
+    """Differentially expressed proteins for one fold change pair"""
+    return master.get_differentially_expressed(
+        experiment_list, aggregated, log2fc_selection, None, replicates, bool(moderated)
+    )
+
+def get_exclusive(aggregated, experiment_list, upset=False):
+    """Exclusive proteins of every experiment"""
+    return master.get_all_exclusive(experiment_list, aggregated, bool(upset), results_dir=None)
+
+def get_all_pairs(aggregated, experiment_list, ordered_pairs=False, top_k=None):
+    """Log2 fold change of every experiment pair"""
+    return master.get_all_log2fc(experiment_list, aggregated, bool(ordered_pairs), top_k, results_dir=None)
+
+def build_pipeline(spill_dir=None, max_bytes=None):
+    """Build the stage graph of sort_data_master"""
+    pipeline = Pipeline(spill_dir, max_bytes)
+    pipeline.add_stage('peptides', load_peptides,
+                       params=('input_file', 'experiment_list', 'compact', 'cache', 'evidence'),
+                       key=get_input_key)
+    pipeline.add_stage('normalized', normalize_peptides, deps=('peptides',),
+                       params=('experiment_list', 'normalization', 'significance_threshold', 'msms_count_threshold'),
+                       key=get_normalized_key)
+    pipeline.add_stage('filtered', filter_peptides, deps=('normalized',),
+                       params=('experiment_list', 'significance_threshold', 'msms_count_threshold'))
+    pipeline.add_stage('aggregated', aggregate_peptides, deps=('normalized', 'filtered'), params=('experiment_list',))
+    pipeline.add_stage('imputed', impute_proteins, deps=('aggregated',), params=('experiment_list', 'impute', 'seed'))
+    pipeline.add_stage('differential', get_differential, deps=('imputed',),
+                       params=('experiment_list', 'log2fc_selection', 'replicates', 'moderated'))
+    pipeline.add_stage('exclusive', get_exclusive, deps=('aggregated',), params=('experiment_list', 'upset'))
+    pipeline.add_stage('all_pairs', get_all_pairs, deps=('imputed',),
+                       params=('experiment_list', 'ordered_pairs', 'top_k'))
+    return pipeline
@@ -0,0 +1,147 @@
+"""
+Per-stage profiling for the MaxQuant pipeline
+
+Stage functions are wrapped with @profiled. While a profile is active, each
+call records its wall time, CPU time, the process's peak RSS so far (a
+high-water mark over the whole run, not the stage's own peak) and the
+shape of the DataFrames going in and out. Results saved on the
+background writer thread are timed there and added to the stage that
+queued them as write_seconds. Otherwise the wrapper only checks one
+global and calls straight through.
+
+"""
+
+import sys
+import json
+import time
+import cProfile
+import functools
+import threading
+import contextlib
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+_active = None
+
+# ===== HELPERS =====
+
+def get_peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+def get_shape(value):
+    """Rows and columns of a DataFrame, or of a dict of DataFrames combined"""
+    if isinstance(value, pd.DataFrame):
+        return list(value.shape)
+    if isinstance(value, dict) and value and all(isinstance(item, pd.DataFrame) for item in value.values()):
+        return [sum(len(item) for item in value.values()), max(item.shape[1] for item in value.values())]
+    return None
+
+# ===== PROFILE =====
+
+class Profile:
+    """Collects one record per profiled stage call"""
+
+    def __init__(self):
+        self.stages = []
+        self.stack = []
+        self.writes = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def run_stage(self, name, function, args, kwargs):
+        """Call a stage function and record its cost"""
+        record = {
+            'stage': name,
+            'depth': len(self.stack),
+            'parent': self.stack[-1]['stage'] if self.stack else None,
+            'shape_in': next((get_shape(arg) for arg in args if get_shape(arg) is not None), None),
+        }
+        self.stages.append(record)
+        self.stack.append(record)
+        record['child_seconds'] = 0.0
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            result = function(*args, **kwargs)
+            record['shape_out'] = get_shape(result)
+            return result
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['self_seconds'] = record['wall_seconds'] - record.pop('child_seconds')
+            record['process_peak_rss_mb'] = get_peak_rss_mb()
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1]['child_seconds'] += record['wall_seconds']
+
+    def record_write(self, record, table, seconds):
+        """Add the time taken to save a table to the stage record that produced it"""
+        with self.lock:
+            self.writes.append({'table': table, 'stage': record['stage'] if record else None, 'seconds': seconds})
+            if record is not None:
+                record['write_seconds'] = record.get('write_seconds', 0.0) + seconds
+
+    def report(self):
+        """Summarize the recorded stages"""
+        with self.lock:
+            return {
+                'total_seconds': time.perf_counter() - self.start,
+                'process_peak_rss_mb': get_peak_rss_mb(),
+                'write_seconds': sum(write['seconds'] for write in self.writes),
+                'stages': self.stages,
+                'writes': self.writes,
+            }
+
+def get_write_context():
+    """The active profile and its running stage record, to time a write done later elsewhere"""
+    if _active is None:
+        return None
+    return _active, _active.stack[-1] if _active.stack else None
+
+def profiled(function):
+    """Record calls to a pipeline stage while a profile is active"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return function(*args, **kwargs)
+        return _active.run_stage(function.__name__, function, args, kwargs)
+    return wrapper
+
+@contextlib.contextmanager
+def profile(report_path=None, dump_path=None):
+    """Profile the pipeline stages run inside the block
+
+    The stage report is written as JSON to report_path, and a flat cProfile
+    dump (readable with pstats or snakeviz) to dump_path. Does nothing when
+    neither is given.
+    """
+    global _active
+    if report_path is None and dump_path is None:
+        yield None
+        return
+
+    previous, _active = _active, Profile()
+    profiler = cProfile.Profile() if dump_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield _active
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(dump_path)
+            print(f"Flat profile saved to {dump_path}")
+        if report_path:
+            with open(report_path, 'w') as handle:
+                json.dump(_active.report(), handle, indent=2)
+            print(f"Stage profile saved to {report_path}")
+        _active = previous
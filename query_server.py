@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Serve the pipeline stages of loaded MaxQuant runs over local HTTP
+
+The runs are parsed once when the server starts and stay in memory, and
+every stage result is memoized by the pipeline (see pipeline.py), up to
+--max-mb with the least recently used results evicted first. Queries are
+JSON objects POSTed to /query, naming a dataset, a stage and the settings
+of the stages it depends on, always including experiment_list and both
+thresholds:
+
+    curl -s localhost:8765/query -d '{
+        "dataset": "run1", "stage": "differential",
+        "experiment_list": [["Exp1", "Ctrl1"], ["Exp2", "Ctrl2"]],
+        "significance_threshold": 0.05, "msms_count_threshold": 2,
+        "log2fc_selection": "1/2"
+    }'
+
+Tables come back as {"columns": [...], "data": [[...], ...]}, limited to
+"limit" rows if given; 'exclusive' returns one such table per experiment,
+and 'filtered' the number of peptides kept. GET /datasets lists the loaded
+runs with their experiments, and GET /stats the memoized results.
+
+"""
+
+import json
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import load_data
+import pipeline
+
+# Stages that can be queried
+STAGES = ('filtered', 'aggregated', 'imputed', 'differential', 'exclusive', 'all_pairs')
+
+# Settings a query may give, besides dataset, stage and limit
+SETTINGS = (
+    'experiment_list', 'significance_threshold', 'msms_count_threshold', 'normalization', 'impute', 'seed',
+    'log2fc_selection', 'replicates', 'moderated', 'upset', 'ordered_pairs', 'top_k',
+)
+
+# ===== DATASETS =====
+
+class QueryEngine:
+    """Loaded runs and the memoized pipeline that answers queries on them
+
+    The parsed runs are pinned in memory; max_bytes only bounds the other
+    results. Stages run one at a time, since the memoized results are
+    shared.
+    """
+
+    def __init__(self, datasets, max_bytes=None, cache=False, evidence=False):
+        self.datasets = dict(datasets)
+        self.options = {'cache': cache, 'evidence': evidence}
+        self.stages = pipeline.build_pipeline(max_bytes=max_bytes)
+        self.stages.pin('peptides')
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Parse every run up front, so the first query does not wait for it"""
+        for name, input_file in self.datasets.items():
+            print(f"Loading {name} from {input_file}")
+            self.stages.get('peptides', input_file=input_file, **self.options)
+
+    def describe(self):
+        """Loaded runs with the experiments found in each"""
+        described = {}
+        for name, input_file in self.datasets.items():
+            experiments = None
+            if not self.options['evidence']:
+                experiments = load_data.discover_experiments(load_data.read_header(input_file))
+            described[name] = {'input_file': input_file, 'experiments': experiments}
+        return described
+
+    def get_settings(self, query):
+        """Check a query and turn it into pipeline settings"""
+        if not isinstance(query, dict):
+            raise ValueError("A query is a JSON object")
+        unknown = set(query) - set(SETTINGS) - {'dataset', 'stage', 'limit'}
+        if unknown:
+            raise ValueError(f"Unknown query keys {sorted(unknown)}")
+        if query.get('dataset') not in self.datasets:
+            raise ValueError(f"Unknown dataset {query.get('dataset')!r}; loaded: {', '.join(self.datasets)}")
+        if query.get('stage') not in STAGES:
+            raise ValueError(f"Unknown stage {query.get('stage')!r}; choose from {', '.join(STAGES)}")
+        check_experiment_list(query.get('experiment_list'))
+        for name in ('significance_threshold', 'msms_count_threshold'):
+            if isinstance(query.get(name), bool) or not isinstance(query.get(name), (int, float)):
+                raise ValueError(f"'{name}' is required and must be a number")
+        for name in ('top_k', 'seed', 'limit'):
+            value = query.get(name)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+                raise ValueError(f"'{name}' must be a non-negative integer, not {value!r}")
+
+        settings = {key: query[key] for key in SETTINGS if key in query}
+        settings['experiment_list'] = [
+            tuple(name) if isinstance(name, (list, tuple)) else name for name in settings['experiment_list']
+        ]
+        input_file = self.datasets[query['dataset']]
+        if not self.options['evidence']:
+            load_data.check_experiments(settings['experiment_list'], load_data.read_header(input_file))
+        if query['stage'] == 'differential' and len(settings['experiment_list']) > 1:
+            load_data.check_log2fc_selection(settings.get('log2fc_selection'), len(settings['experiment_list']))
+        return {**settings, **self.options, 'input_file': input_file}
+
+    def query(self, query):
+        """Answer a query with a JSON-ready result"""
+        settings = self.get_settings(query)
+        with self.lock:
+            result = self.stages.get(query['stage'], **settings)
+        if isinstance(result, np.ndarray):
+            return {'peptides': int(result.sum())}
+        if isinstance(result, dict):
+            return {name: to_json(table, query.get('limit')) for name, table in result.items()}
+        return to_json(result, query.get('limit'))
+
+    def get_stats(self):
+        """Number and size of the memoized results"""
+        with self.lock:
+            return {
+                'results': len(self.stages.results),
+                'bytes': self.stages.get_memory_usage(),
+                'max_bytes': self.stages.max_bytes,
+            }
+
+def check_experiment_list(experiment_list):
+    """Check that experiment_list holds either experiment names or [experiment, control] pairs"""
+    if not isinstance(experiment_list, list) or not experiment_list:
+        raise ValueError("'experiment_list' is required, as a list of names or of [experiment, control] pairs")
+    names = all(isinstance(entry, str) for entry in experiment_list)
+    pairs = all(
+        isinstance(entry, list) and len(entry) == 2 and all(isinstance(name, str) for name in entry)
+        for entry in experiment_list
+    )
+    if not (names or pairs):
+        raise ValueError("'experiment_list' must hold either only experiment names or only "
+                         "[experiment, control] pairs")
+
+def to_json(table, limit=None):
+    """A table as columns and rows, NaN as null"""
+    if limit is not None:
+        table = table.head(int(limit))
+    return json.loads(table.to_json(orient='split', index=False))
+
+# ===== HTTP =====
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP front end of a QueryEngine"""
+
+    engine = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, function, *args):
+        """Send function's result, or the error it raised"""
+        try:
+            self.send_json(200, function(*args))
+        except (ValueError, KeyError) as error:
+            self.send_json(400, {'error': str(error)})
+        except Exception as error:
+            self.send_json(500, {'error': f"{type(error).__name__}: {error}"})
+
+    def do_GET(self):
+        if self.path == '/datasets':
+            self.answer(self.engine.describe)
+        elif self.path == '/stats':
+            self.answer(self.engine.get_stats)
+        else:
+            self.send_json(404, {'error': f"No such endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/query':
+            self.send_json(404, {'error': f"No such endpoint {self.path}"})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except json.JSONDecodeError as error:
+            self.send_json(400, {'error': f"Invalid JSON: {error}"})
+            return
+        self.answer(self.engine.query, query)
+
+def serve(engine, host='127.0.0.1', port=8765):
+    """Answer queries until interrupted"""
+    handler = type('Handler', (QueryHandler,), {'engine': engine})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving {', '.join(engine.datasets)} on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    """Main function to run the server"""
+    parser = argparse.ArgumentParser(description='Keep MaxQuant runs in memory and answer pipeline queries over HTTP.')
+    parser.add_argument('datasets', nargs='+', metavar='NAME=PATH',
+                        help='Runs to load, e.g. run1=run1/peptides.txt')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default: 8765)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1, only this machine)')
+    parser.add_argument('--max-mb', type=float, default=None,
+                        help='Evict the least recently used results once they take up more than this many MB')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep a binary copy of each parsed peptides.txt to speed up later starts')
+    parser.add_argument('--evidence', action='store_true',
+                        help='The runs are evidence.txt files; roll them up into peptides while loading')
+    args = parser.parse_args()
+
+    datasets = {}
+    for entry in args.datasets:
+        name, separator, path = entry.partition('=')
+        if not separator:
+            parser.error(f"Datasets are given as NAME=PATH, not {entry!r}")
+        datasets[name] = path
+    max_bytes = int(args.max_mb * 2 ** 20) if args.max_mb is not None else None
+
+    engine = QueryEngine(datasets, max_bytes, args.cache, args.evidence)
+    engine.load()
+    serve(engine, args.host, args.port)
+
+if __name__ == "__main__":
+    main()
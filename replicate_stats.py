@@ -0,0 +1,273 @@
+"""
+Replicate-aware differential expression statistics
+
+Samples are grouped into conditions (e.g. {"Treated": ["T1", "T2", "T3"],
+"Control": ["C1", "C2", "C3"]}) and every pair of conditions is compared on
+log2 intensities, for all proteins and comparisons at once:
+
+- Welch's t-test, or
+- a limma-style moderated t-test, where the pooled variance of each protein
+  is shrunk towards a prior fitted across all proteins (Smyth, 2004).
+
+P-values are adjusted per comparison with Benjamini-Hochberg. scipy is used
+for the distribution functions when it is installed; otherwise they are
+computed with numpy.
+
+"""
+
+import os
+import json
+import math
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy import special
+except ImportError:
+    special = None
+
+# ===== DISTRIBUTIONS =====
+
+def _lgamma(x):
+    """Log gamma function for positive x, elementwise"""
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    while (x < 10).any():
+        small = x < 10
+        result[small] -= np.log(x[small])
+        x[small] += 1
+    f = 1 / (x * x)
+    return result + (x - 0.5) * np.log(x) - x + 0.5 * math.log(2 * math.pi) + \
+        (1 / 12 - f * (1 / 360 - f * (1 / 1260 - f * (1 / 1680 - f / 1188)))) / x
+
+def _betainc(a, b, x, iterations=300, tolerance=1e-12):
+    """Regularized incomplete beta function I_x(a, b), elementwise
+
+    Evaluates the continued fraction with the modified Lentz method, using
+    the symmetry I_x(a, b) = 1 - I_(1-x)(b, a) where it converges faster.
+    Elements drop out of the iteration as soon as they have converged.
+    """
+    a, b, x = np.broadcast_arrays(*(np.asarray(value, dtype=np.float64) for value in (a, b, x)))
+    flip = x > (a + 1) / (a + b + 2)
+    a, b, x = np.where(flip, b, a), np.where(flip, a, b), np.where(flip, 1 - x, x)
+
+    tiny = 1e-300
+    with np.errstate(divide='ignore', invalid='ignore'):
+        front = np.exp(_lgamma(a + b) - _lgamma(a) - _lgamma(b) + a * np.log(x) + b * np.log1p(-x)) / a
+        d = 1 - (a + b) * x / (a + 1)
+        d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+        fraction = d.ravel().copy()
+
+        # Only the elements still converging, compacted
+        active = np.arange(fraction.size)
+        a_active, b_active, x_active = a.ravel(), b.ravel(), x.ravel()
+        c_active, d_active, fraction_active = np.ones_like(fraction), fraction.copy(), fraction.copy()
+        for m in range(1, iterations + 1):
+            for numerator in (m * (b_active - m) * x_active / ((a_active + 2 * m - 1) * (a_active + 2 * m)),
+                              -(a_active + m) * (a_active + b_active + m) * x_active /
+                              ((a_active + 2 * m) * (a_active + 2 * m + 1))):
+                d_active = 1 + numerator * d_active
+                d_active = 1 / np.where(np.abs(d_active) < tiny, tiny, d_active)
+                c_active = 1 + numerator / c_active
+                c_active = np.where(np.abs(c_active) < tiny, tiny, c_active)
+                delta = c_active * d_active
+                fraction_active *= delta
+            fraction[active] = fraction_active
+            going = np.abs(delta - 1) >= tolerance
+            if not going.any():
+                break
+            active, a_active, b_active, x_active = active[going], a_active[going], b_active[going], x_active[going]
+            c_active, d_active, fraction_active = c_active[going], d_active[going], fraction_active[going]
+        result = np.where(x <= 0, 0.0, front * fraction.reshape(x.shape))
+    return np.where(flip, 1 - result, result)
+
+def t_sf_two_sided(t, df):
+    """Two-sided p-value of Student's t distribution"""
+    t, df = np.broadcast_arrays(np.asarray(t, dtype=np.float64), np.asarray(df, dtype=np.float64))
+    valid = np.isfinite(t) & (df > 0)
+    p = np.full(t.shape, np.nan)
+    if special is not None:
+        p[valid] = 2 * special.stdtr(df[valid], -np.abs(t[valid]))
+    elif valid.any():
+        df_valid = df[valid]
+        p[valid] = _betainc(df_valid / 2, 0.5, df_valid / (df_valid + t[valid] ** 2))
+    return np.clip(p, 0.0, 1.0)
+
+def _digamma(x):
+    """Digamma function for positive x, elementwise"""
+    if special is not None:
+        return special.digamma(x)
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    while (x < 6).any():
+        small = x < 6
+        result[small] -= 1 / x[small]
+        x[small] += 1
+    f = 1 / (x * x)
+    return result + np.log(x) - 0.5 / x - f * (1 / 12 - f * (1 / 120 - f * (1 / 252 - f * (1 / 240 - f / 132))))
+
+def _polygamma(n, x):
+    """Trigamma (n = 1) or tetragamma (n = 2) function for positive x, elementwise"""
+    if special is not None:
+        return special.polygamma(n, x)
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros_like(x)
+    while (x < 6).any():
+        small = x < 6
+        result[small] += (1 if n == 1 else -2) / x[small] ** (n + 1)
+        x[small] += 1
+    if n == 1:
+        return result + 1 / x + 1 / (2 * x ** 2) + 1 / (6 * x ** 3) - 1 / (30 * x ** 5) + 1 / (42 * x ** 7) - 1 / (30 * x ** 9)
+    return result - 1 / x ** 2 - 1 / x ** 3 - 1 / (2 * x ** 4) + 1 / (6 * x ** 6) - 1 / (6 * x ** 8) + 3 / (10 * x ** 10)
+
+def _trigamma_inverse(y):
+    """Solve trigamma(x) = y with Newton's method, as in limma"""
+    if y > 1e7:
+        return 1 / math.sqrt(y)
+    if y < 1e-6:
+        return 1 / y
+    x = 0.5 + 1 / y
+    for _ in range(50):
+        trigamma = _polygamma(1, x)
+        step = trigamma * (1 - trigamma / y) / _polygamma(2, x)
+        x += step
+        if -step / x < 1e-8:
+            break
+    return float(x)
+
+# ===== TESTS =====
+
+def get_condition_summaries(log_intensity, groups):
+    """Number of values, mean and sample variance of each protein in each condition"""
+    n = np.empty((log_intensity.shape[0], len(groups)))
+    mean = np.full_like(n, np.nan)
+    var = np.full_like(n, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for k, columns in enumerate(groups):
+            values = log_intensity[:, columns]
+            observed = ~np.isnan(values)
+            n[:, k] = observed.sum(axis=1)
+            total = np.where(observed, values, 0.0).sum(axis=1)
+            mean[:, k] = np.where(n[:, k] > 0, total / n[:, k], np.nan)
+            squares = np.where(observed, (values - mean[:, k, None]) ** 2, 0.0).sum(axis=1)
+            var[:, k] = np.where(n[:, k] > 1, squares / (n[:, k] - 1), np.nan)
+    return n, mean, var
+
+def welch_test(n, mean, var, first, second):
+    """Welch's t statistic and degrees of freedom for each protein and comparison"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error_a, error_b = var[:, first] / n[:, first], var[:, second] / n[:, second]
+        standard_error = error_a + error_b
+        t = (mean[:, first] - mean[:, second]) / np.sqrt(standard_error)
+        df = standard_error ** 2 / (error_a ** 2 / (n[:, first] - 1) + error_b ** 2 / (n[:, second] - 1))
+    return t, df
+
+def fit_variance_prior(variance, df):
+    """Fit the scaled inverse chi-square prior of the protein variances (limma's fitFDist)"""
+    usable = np.isfinite(variance) & (variance > 0) & (df > 0)
+    variance, df = variance[usable], df[usable]
+    if len(variance) < 3:
+        return 0.0, np.nan
+    z = np.log(variance)
+    e = z - _digamma(df / 2) + np.log(df / 2)
+    e_mean = e.mean()
+    e_var = ((e - e_mean) ** 2).sum() / (len(e) - 1) - _polygamma(1, df / 2).mean()
+    if e_var <= 0:
+        return np.inf, math.exp(e_mean)
+    prior_df = 2 * _trigamma_inverse(e_var)
+    return prior_df, math.exp(e_mean + _digamma(prior_df / 2) - math.log(prior_df / 2))
+
+def moderated_test(n, mean, var, first, second):
+    """Moderated t statistic and degrees of freedom for each protein and comparison
+
+    The residual variance pooled over all conditions is shrunk towards a
+    prior fitted across proteins, which gains degrees of freedom for
+    proteins with few replicates.
+    """
+    residual_df = np.clip(n - 1, 0, None).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = np.where(np.isnan(var), 0.0, var * (n - 1)).sum(axis=1) / residual_df
+    prior_df, prior_var = fit_variance_prior(pooled, residual_df)
+    if np.isinf(prior_df):
+        posterior = np.full_like(pooled, prior_var)
+    elif prior_df > 0:
+        posterior = (prior_df * prior_var + residual_df * np.nan_to_num(pooled)) / (prior_df + residual_df)
+    else:
+        posterior = pooled
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (mean[:, first] - mean[:, second]) / \
+            np.sqrt(posterior[:, None] * (1 / n[:, first] + 1 / n[:, second]))
+    df = np.broadcast_to((residual_df + min(prior_df, 1e6))[:, None], t.shape)
+    return t, df
+
+def bh_qvalues(p):
+    """Benjamini-Hochberg q-values of each column of p, ignoring missing p-values"""
+    q = np.full(p.shape, np.nan)
+    order = np.argsort(p, axis=0)
+    sorted_p = np.take_along_axis(p, order, axis=0)
+    m = np.isfinite(p).sum(axis=0)
+    rank = np.arange(1, p.shape[0] + 1)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        adjusted = sorted_p * m / rank
+    adjusted = np.where(np.isfinite(sorted_p), adjusted, np.inf)
+    adjusted = np.minimum.accumulate(adjusted[::-1], axis=0)[::-1]
+    adjusted = np.where(np.isfinite(sorted_p), np.minimum(adjusted, 1.0), np.nan)
+    np.put_along_axis(q, order, adjusted, axis=0)
+    return q
+
+# ===== STATISTICS STAGE =====
+
+def read_replicates(replicates):
+    """Read a condition -> replicates mapping from a JSON file or JSON string"""
+    if isinstance(replicates, dict):
+        return replicates
+    if os.path.exists(replicates):
+        with open(replicates) as handle:
+            return json.load(handle)
+    return json.loads(replicates)
+
+def get_comparisons(replicates, comparisons=None):
+    """Condition pairs to test: the given ones, or every pair in mapping order"""
+    conditions = list(replicates)
+    if comparisons is None:
+        return [(conditions[i], conditions[j]) for i in range(len(conditions)) for j in range(i + 1, len(conditions))]
+    comparisons = [tuple(comparison) for comparison in comparisons]
+    unknown = {condition for comparison in comparisons for condition in comparison} - set(conditions)
+    if unknown:
+        raise ValueError(f"Unknown conditions in comparisons: {sorted(unknown)}")
+    return comparisons
+
+def test_replicates(exp_names, intensity, replicates, comparisons=None, moderated=False, index=None):
+    """Compare every pair of conditions across all proteins
+
+    intensity is the proteins x experiments matrix for exp_names; values of
+    zero or less are treated as missing. Returns a DataFrame with the mean
+    log2 fold change, p-value and BH q-value of each comparison.
+    """
+    replicates = read_replicates(replicates)
+    unknown = {name for names in replicates.values() for name in names} - set(exp_names)
+    if unknown:
+        raise ValueError(f"Replicates not among the experiments: {sorted(unknown)}")
+    comparisons = get_comparisons(replicates, comparisons)
+    conditions = list(replicates)
+    print(f"Testing {len(comparisons)} condition comparisons with "
+          f"{'moderated' if moderated else 'Welch'} t-tests")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_intensity = np.where(intensity > 0, np.log2(intensity), np.nan)
+    groups = [[exp_names.index(name) for name in replicates[condition]] for condition in conditions]
+    n, mean, var = get_condition_summaries(log_intensity, groups)
+
+    first = np.array([conditions.index(a) for a, _ in comparisons], dtype=np.int64)
+    second = np.array([conditions.index(b) for _, b in comparisons], dtype=np.int64)
+    t, df = (moderated_test if moderated else welch_test)(n, mean, var, first, second)
+    p = t_sf_two_sided(t, df)
+    q = bh_qvalues(p)
+
+    columns = {}
+    for c, (a, b) in enumerate(comparisons):
+        columns[f'Mean Log2FC {a}/{b}'] = mean[:, first[c]] - mean[:, second[c]]
+        columns[f'P-value {a}/{b}'] = p[:, c]
+        columns[f'Q-value {a}/{b}'] = q[:, c]
+    return pd.DataFrame(columns, index=index)
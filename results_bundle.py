@@ -0,0 +1,222 @@
+"""
+Result output: columnar bundles and background writing
+
+Instead of one full-width CSV per result, a bundle is a directory of
+Parquet files (requires pyarrow) with a bundle.json index:
+
+    results/results_bundle/
+        bundle.json
+        aggregated_data.parquet
+        differential_expression.parquet
+        A_exclusive_expression.parquet
+        ...
+
+The aggregated table is stored once. A result whose rows are rows of the
+aggregated table is stored as a 'Protein index' column, pointing at those
+rows, plus only the columns it adds or changes. Added columns that are
+copies of an aggregated column are stored as a reference to that column.
+read_table puts the full table back together.
+
+A BackgroundWriter saves tables on a separate thread, so formatting and
+writing one result overlaps with computing the next.
+
+"""
+
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+import pandas as pd
+import profiling
+
+BUNDLE_DIR = "results_bundle"
+BASE_TABLE = "aggregated_data"
+
+# ===== WRITING =====
+
+def hash_values(column):
+    """Digest of a column's values and dtype, ignoring its index"""
+    hashed = pd.util.hash_pandas_object(column, index=False).to_numpy()
+    return hashlib.blake2b(hashed.tobytes() + str(column.dtype).encode(), digest_size=16).digest()
+
+class BundleWriter:
+    """Collects the result tables of a run into one bundle directory"""
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        self.tables = {}
+        self.aggregated = None
+        os.makedirs(bundle_dir, exist_ok=True)
+
+    def get_reference(self, table):
+        """Locate table's rows in the aggregated table
+
+        Returns the row positions, the columns that must be stored and the
+        columns that copy an aggregated column, or None if table is not made
+        of aggregated rows.
+        """
+        if self.aggregated is None or not table.index.is_unique:
+            return None
+        positions = self.aggregated.index.get_indexer(table.index)
+        if (positions < 0).any():
+            return None
+        base_rows = self.aggregated.iloc[positions].reset_index(drop=True)
+        rows = table.reset_index(drop=True)
+        by_values = {}
+        for column in base_rows.columns:
+            by_values.setdefault(hash_values(base_rows[column]), column)
+
+        changed, aliases = [], {}
+        for column in rows.columns:
+            if column in base_rows.columns and rows[column].equals(base_rows[column]):
+                continue
+            source = by_values.get(hash_values(rows[column]))
+            if source is not None and rows[column].equals(base_rows[source]):
+                aliases[column] = source
+            else:
+                changed.append(column)
+        if len(changed) == len(rows.columns):
+            return None
+        return positions, changed, aliases
+
+    def write(self, name, table, file_format=None):
+        """Add a result table to the bundle (always as Parquet, whatever file_format)"""
+        reference = None if name == BASE_TABLE else self.get_reference(table)
+        if reference is None:
+            stored, aliases = table.reset_index(drop=True), {}
+        else:
+            positions, changed, aliases = reference
+            stored = table[changed].reset_index(drop=True)
+            stored.insert(0, 'Protein index', positions)
+        stored.to_parquet(os.path.join(self.bundle_dir, f"{name}.parquet"), index=False)
+
+        if name == BASE_TABLE:
+            self.aggregated = table
+        self.tables[name] = {
+            'rows_of': None if reference is None else BASE_TABLE,
+            'columns': [str(column) for column in table.columns],
+            'aliases': aliases,
+        }
+        self.save_index()
+
+    def save_index(self):
+        """Write bundle.json, listing the tables written so far"""
+        index_path = os.path.join(self.bundle_dir, "bundle.json")
+        with open(f"{index_path}.tmp", 'w') as handle:
+            json.dump({'tables': self.tables}, handle, indent=2)
+        os.replace(f"{index_path}.tmp", index_path)
+
+def write_results(table, name, results_dir, writer=None, file_format='csv'):
+    """Save a result table to the bundle writer, or else to results_dir
+
+    The file is name.csv, or name.arrow (uncompressed Arrow IPC, which can
+    be memory-mapped back) or name.parquet with file_format. Nothing is
+    saved when both writer and results_dir are None.
+    """
+    if writer is not None:
+        writer.write(name, table, file_format)
+    elif results_dir is None:
+        return
+    elif file_format == 'csv':
+        table.to_csv(os.path.join(results_dir, f"{name}.csv"), index=False)
+    else:
+        # Replace the file rather than overwrite it, since it may still be memory-mapped
+        path = os.path.join(results_dir, f"{name}.{file_format}")
+        if file_format == 'arrow':
+            table.reset_index(drop=True).to_feather(f"{path}.tmp", compression='uncompressed')
+        else:
+            table.to_parquet(f"{path}.tmp", index=False)
+        os.replace(f"{path}.tmp", path)
+
+class BackgroundWriter:
+    """Saves result tables on a writer thread while the analyses go on
+
+    Tables are queued, at most max_pending at a time so that a slow disk
+    holds the analyses back instead of filling memory, and saved with
+    write_results to writer if given, else to results_dir. Tables must not
+    be modified once queued. While a profile is active, the time spent
+    saving each table is added to the stage that queued it. The first error
+    on the writer thread is raised by the next write or by close; as a
+    context manager, the writer is closed on exit.
+    """
+
+    def __init__(self, results_dir, writer=None, max_pending=4):
+        self.results_dir = results_dir
+        self.writer = writer
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.run, name='result-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Write queued tables until close; after an error, only drain the queue"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                name, table, file_format, context = item
+                start = time.perf_counter()
+                try:
+                    write_results(table, name, self.results_dir, self.writer, file_format)
+                except BaseException as error:
+                    self.error = error
+                if context is not None:
+                    profile, record = context
+                    profile.record_write(record, name, time.perf_counter() - start)
+
+    def write(self, name, table, file_format='csv'):
+        """Queue a result table, waiting while max_pending tables are queued"""
+        self.raise_error()
+        self.queue.put((name, table, file_format, profiling.get_write_context()))
+
+    def raise_error(self):
+        """Raise the error that stopped the writer thread, if any"""
+        if self.error is not None:
+            raise self.error
+
+    def join(self):
+        """Wait until every queued table has been handled"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self):
+        """Finish writing, then raise the first error if any"""
+        self.join()
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # An error in the analyses takes precedence over one in writing
+            self.join()
+        return False
+
+# ===== READING =====
+
+def read_index(bundle_dir):
+    """Tables listed in a bundle's bundle.json"""
+    index_path = os.path.join(bundle_dir, "bundle.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as handle:
+        return json.load(handle)['tables']
+
+def read_table(bundle_dir, name):
+    """Load a table from a bundle, joining references back onto the aggregated rows"""
+    entry = read_index(bundle_dir)[name]
+    stored = pd.read_parquet(os.path.join(bundle_dir, f"{name}.parquet"))
+    if entry['rows_of'] is None:
+        return stored
+    base = pd.read_parquet(os.path.join(bundle_dir, f"{entry['rows_of']}.parquet"))
+    rows = base.iloc[stored.pop('Protein index').to_numpy()].reset_index(drop=True)
+    copies = pd.DataFrame({column: rows[source] for column, source in entry['aliases'].items()}, index=rows.index)
+    rows = pd.concat([rows.drop(columns=stored.columns, errors='ignore'), stored, copies], axis=1)
+    return rows[entry['columns']]
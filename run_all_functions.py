@@ -1,9 +1,9 @@
 import numpy as np
-import pandas as pd
 import normalize_data_dyn as norm
 import normalize_data_no_controls_dyn as norm_exponly
 import sort_data_dyn as sort
 import common_data as common
+import load_data
 
 # Ask whether the user has experiments only or experiments with corresponding controls
 def get_data_type():
@@ -26,6 +26,5 @@ def preprocess_data(experimental_data):
 raw_data = "experimental_data/peptides.txt" # Path to your peptides.txt file
 # preprocess_data(raw_data)
 
-# Sort aggregated_data.csv by experiment/differential expression
-aggregated_data = pd.read_csv("results/aggregated_data.csv")
-sort.main(aggregated_data)
+# Sort the aggregated table (aggregated_data.csv, .arrow or .parquet) by experiment/differential expression
+sort.main(load_data.get_aggregated_path("results"))
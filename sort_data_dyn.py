@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import load_data
 
 def get_experiments():
     experiments = []
@@ -58,6 +59,8 @@ def get_experiment_exclusive(experiment_list, experimental_data, exp_index):
     return exclusive_expression
 
 def main(experimental_data):
+    # Accepts the aggregated table or the path of a saved one; Arrow files are memory-mapped
+    experimental_data = load_data.load_aggregated(experimental_data)
     experiment_list = get_experiments()
     
     get_differentially_expressed(experiment_list, experimental_data)
@@ -8,6 +8,14 @@ import os
 import numpy as np
 import pandas as pd
 import argparse
+import aggregation
+import imputation
+import load_data
+from experiment_matrix import NORMALIZATIONS, ExperimentMatrix, append_columns, replace_columns
+import profiling
+import replicate_stats
+import results_bundle
+from results_bundle import write_results
 
 # Create directories if they don't exist
 os.makedirs("experimental_data", exist_ok=True)
@@ -15,12 +23,44 @@ os.makedirs("results", exist_ok=True)
 
 # ===== DATA CONVERSION AND PREPARATION FUNCTIONS =====
 
-def convert_txt(experimental_data_txt):
-    """Convert peptides.txt to CSV format"""
-    print("Converting peptides.txt into a .csv")
-    experimental_data = pd.read_csv(experimental_data_txt, delimiter="\t")
-    experimental_data.to_csv("experimental_data/peptides.csv", index=False)
-    return experimental_data
+@profiling.profiled
+def convert_txt(experimental_data_txt, significance_threshold=None, msms_count_threshold=None, chunksize=None,
+                experiment_list=None, compact=False, cache=False, evidence=False):
+    """Read peptides.txt into a DataFrame
+
+    If chunksize is given, the file is streamed in chunks of that many rows and
+    the PEP, MS/MS count and contaminant filters are applied to each chunk as it
+    is read, so only surviving peptides are kept in memory.
+
+    If compact is set, only the columns needed for experiment_list are parsed,
+    using compact dtypes.
+
+    If cache is set, the parsed table is kept in a binary cache keyed by the
+    file contents, so later runs on the same file skip parsing the text.
+
+    If evidence is set, the input is MaxQuant's evidence.txt, which is
+    streamed and rolled up into the same peptide columns.
+    """
+    columns = load_data.get_required_columns(experiment_list) if compact else None
+    cache_dir = load_data.CACHE_DIR if cache else None
+
+    if evidence:
+        print("Streaming evidence.txt")
+        experimental_data = load_data.read_evidence(experimental_data_txt, chunksize or 100000, cache_dir)
+        if chunksize:
+            experimental_data = load_data.filter_peptides(experimental_data, significance_threshold, msms_count_threshold)
+        if columns is not None:
+            experimental_data = load_data.compact_dtypes(experimental_data[columns].copy())
+        return experimental_data
+
+    if chunksize:
+        print(f"Streaming peptides.txt in chunks of {chunksize} rows")
+        return load_data.read_peptides_chunked(
+            experimental_data_txt, significance_threshold, msms_count_threshold, chunksize, columns, cache_dir
+        )
+
+    print("Reading peptides.txt")
+    return load_data.read_peptides(experimental_data_txt, columns, cache_dir)
 
 # ===== USER INPUT FUNCTIONS =====
 
@@ -36,31 +76,74 @@ def get_analysis_type():
             return int(choice)
         print("Invalid choice. Please enter 1 or 2.")
 
-def get_experiments_with_controls():
-    """Get experiment/control pairs from user"""
+def ask_experiment(prompt, available=None, allow_done=False):
+    """Ask for an experiment name until it is one of available (any name if None)"""
+    while True:
+        name = input(prompt)
+        if available is None or name in available or (allow_done and name.lower() == 'done'):
+            return name
+        print(f"'{name}' is not in the input file. Available experiments: {', '.join(available)}")
+
+def get_experiments_with_controls(available=None):
+    """Get experiment/control pairs from user
+
+    With available, the experiments found in the input file are listed and
+    names not among them are asked for again.
+    """
     experiment_list = []
+    if available is not None:
+        print(f"\nExperiments in the input file: {', '.join(available)}")
     print("\nEnter experiment/control pairs (type 'done' to finish):")
     while True:
-        experiment = input("Enter experiment name (or type 'done' to finish): ")
+        experiment = ask_experiment("Enter experiment name (or type 'done' to finish): ", available, allow_done=True)
         if experiment.lower() == 'done':
             break
-        control = input(f"Enter control name for {experiment}: ")
+        control = ask_experiment(f"Enter control name for {experiment}: ", available)
         experiment_list.append((experiment, control))
     print("\n")
     return experiment_list
 
-def get_experiments_without_controls():
-    """Get experiment names from user without controls"""
+def get_experiments_without_controls(available=None):
+    """Get experiment names from user without controls
+
+    With available, the experiments found in the input file are listed and
+    names not among them are asked for again.
+    """
     experiment_list = []
+    if available is not None:
+        print(f"\nExperiments in the input file: {', '.join(available)}")
     print("\nEnter experiment names (type 'done' to finish):")
     while True:
-        experiment = input("Enter experiment name (or type 'done' to finish): ")
+        experiment = ask_experiment("Enter experiment name (or type 'done' to finish): ", available, allow_done=True)
         if experiment.lower() == 'done':
             break
         experiment_list.append(experiment)
     print("\n")
     return experiment_list
 
+def preflight(experimental_data_txt, experiment_list=None, with_controls=True, evidence=False):
+    """Check the experiments against the input file's header before any data is parsed
+
+    Only the header line is read, so a wrong name fails at once whatever the
+    size of the file. Experiments that are not given are asked for, offering
+    the ones found in the header; a header without any experiments raises
+    ValueError. evidence.txt is not checked, since its experiments are only
+    known from its rows.
+    """
+    columns = None if evidence else load_data.read_header(experimental_data_txt)
+    available = None if columns is None else load_data.discover_experiments(columns)
+    if available == []:
+        raise ValueError(f"No experiments found in {experimental_data_txt}: it has no matching "
+                         f"'Intensity X' and 'Experiment X' columns")
+    if experiment_list is None:
+        if with_controls:
+            experiment_list = get_experiments_with_controls(available)
+        else:
+            experiment_list = get_experiments_without_controls(available)
+    if columns is not None:
+        load_data.check_experiments(experiment_list, columns)
+    return experiment_list
+
 def select_significance():
     """Get PEP threshold from user"""
     return float(input("Enter PEP upper threshold (e.g. 0.05): "))
@@ -69,6 +152,14 @@ def select_msms_count():
     """Get MS/MS count threshold from user"""
     return float(input("Enter MS/MS count lower threshold (e.g. 2): "))
 
+def select_thresholds():
+    """Get PEP and MS/MS count thresholds from user"""
+    print('\n')
+    significance_threshold = select_significance()
+    msms_count_threshold = select_msms_count()
+    print('\n')
+    return significance_threshold, msms_count_threshold
+
 def select_log2fc(experiment_list):
     """Let user select how Log2 fold change should be calculated"""
     print("\nSelect how Log2 fold change should be calculated:")
@@ -83,15 +174,7 @@ def select_log2fc(experiment_list):
 
 # ===== DATA PROCESSING FUNCTIONS =====
 
-def remove_nan_with_controls(experiment_list, experimental_data):
-    """Replace NaN values with zeros for experiments with controls"""
-    print('Replacing NaN values')
-    
-    for experiment, control in experiment_list:
-        experimental_data[f'Experiment {experiment}'] = experimental_data[f'Experiment {experiment}'].fillna(0)
-        experimental_data[f'Experiment {control}'] = experimental_data[f'Experiment {control}'].fillna(0)
-    return experimental_data
-
+@profiling.profiled
 def remove_nan_without_controls(experiment_list, experimental_data):
     """Replace NaN values with zeros for experiments without controls"""
     print("Removing NaN values")
@@ -100,80 +183,163 @@ def remove_nan_without_controls(experiment_list, experimental_data):
     
     return experimental_data
 
+@profiling.profiled
 def normalize_intensity(experiment_list, experimental_data):
-    """Subtract control from experiment intensities"""
+    """Subtract control from experiment intensities
+
+    Works on the dense intensity and count matrices, with missing counts
+    taken as zero, and appends the 'Count X' and 'Intensity Experiment X'
+    columns in one block.
+    """
     print('Normalizing intensity and count')
-    experimental_data = remove_nan_with_controls(experiment_list, experimental_data)
-    
+    matrix = ExperimentMatrix.from_frame(experimental_data, load_data.get_sample_names(experiment_list))
+    normalized = matrix.subtract_controls(experiment_list)
+
+    # Keep the dtypes subtracting the columns one by one would give
+    dtypes = {}
     for experiment, control in experiment_list:
-        experimental_data[f'Count {experiment}'] = experimental_data[f'Experiment {experiment}'] - experimental_data[f'Experiment {control}']
-        experimental_data[f'Intensity Experiment {experiment}'] = experimental_data[f'Intensity {experiment}'] - experimental_data[f'Intensity {control}']
-    
-    return experimental_data
+        dtypes[f'Count {experiment}'] = np.result_type(
+            experimental_data[f'Experiment {experiment}'].dtype, experimental_data[f'Experiment {control}'].dtype
+        )
+        dtypes[f'Intensity Experiment {experiment}'] = np.result_type(
+            experimental_data[f'Intensity {experiment}'].dtype, experimental_data[f'Intensity {control}'].dtype
+        )
+    columns = normalized.to_frame('Intensity Experiment ', 'Count ', count_first=True, dtypes=dtypes,
+                                  index=experimental_data.index)
+    return append_columns(experimental_data, columns)
+
+def add_experiment_columns(experiment_list, experimental_data):
+    """Copy the columns of experiments without controls to the names the analyses use
 
-def filter_data_with_controls(experiment_list, experimental_data):
+    Returns a new table with 'Intensity Experiment X' and 'Count X' appended
+    in one block, unless they are already there.
+    """
+    missing = [exp for exp in experiment_list if f'Count {exp}' not in experimental_data.columns]
+    if not missing:
+        return experimental_data
+    matrix = ExperimentMatrix.from_frame(experimental_data, missing)
+    dtypes = {}
+    for exp in missing:
+        dtypes[f'Intensity Experiment {exp}'] = experimental_data[f'Intensity {exp}'].dtype
+        dtypes[f'Count {exp}'] = experimental_data[f'Experiment {exp}'].dtype
+    columns = matrix.to_frame('Intensity Experiment ', 'Count ', dtypes=dtypes, index=experimental_data.index)
+    return append_columns(experimental_data, columns)
+
+def get_nonempty_mask(experiment_list, experimental_data):
+    """Rows where not ALL experiments have Intensity ≤ 0 and Count = 0"""
+    if isinstance(experiment_list[0], tuple):
+        exp_names = [exp for exp, _ in experiment_list]
+        count_columns = [f'Count {exp}' for exp in exp_names]
+    else:
+        exp_names = experiment_list
+        count_columns = [f'Experiment {exp}' for exp in exp_names]
+
+    # One column at a time, so no N x E block is copied out of the frame;
+    # missing counts are taken as zero
+    has_intensity = np.zeros(len(experimental_data), dtype=bool)
+    has_count = np.zeros(len(experimental_data), dtype=bool)
+    for intensity_column, count_column in zip([f'Intensity {exp}' for exp in exp_names], count_columns):
+        has_intensity |= ~(experimental_data[intensity_column].to_numpy() <= 0)
+        count = experimental_data[count_column].to_numpy()
+        has_count |= (count != 0) & ~pd.isna(count)
+    return has_intensity & has_count
+
+def get_threshold_mask(experimental_data, significance_threshold=None, msms_count_threshold=None):
+    """Rows passing the contaminant filter and the MS/MS count and PEP thresholds (skipped when None)"""
+    keep = experimental_data['Potential contaminant'].isna().to_numpy()
+    if significance_threshold is not None and msms_count_threshold is not None:
+        keep &= experimental_data['MS/MS Count'].to_numpy() >= msms_count_threshold
+        keep &= experimental_data['PEP'].to_numpy() <= significance_threshold
+    return keep
+
+def get_row_mask(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None):
+    """Compose every row filter into a single boolean mask over the peptides
+
+    Combines the MS/MS count and PEP thresholds (skipped when None), the
+    contaminant filter and the empty-row filter without materializing any
+    intermediate frame.
+    """
+    keep = get_threshold_mask(experimental_data, significance_threshold, msms_count_threshold)
+    return keep & get_nonempty_mask(experiment_list, experimental_data)
+
+@profiling.profiled
+def normalize_samples(experiment_list, experimental_data, method, rows=None):
+    """Normalize the intensities of all samples against each other
+
+    method is 'median', 'total' or 'quantile' (see
+    ExperimentMatrix.normalize_samples). The statistics are taken over the
+    rows mask, normally the peptides that pass the thresholds.
+    """
+    print(f"Normalizing sample intensities ({method})")
+    names = load_data.get_sample_names(experiment_list)
+    matrix = ExperimentMatrix.from_frame(experimental_data, names).normalize_samples(method, rows)
+    return replace_columns(experimental_data, matrix.to_frame('Intensity ', None, index=experimental_data.index))
+
+@profiling.profiled
+def filter_data_with_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None):
     """Filter data for experiments with controls"""
     print('Filtering data')
     experimental_data = normalize_intensity(experiment_list, experimental_data)
-    print('\n')
-    significance_threshold = select_significance()
-    msms_count_threshold = select_msms_count()
-    print('\n')
+    if significance_threshold is None or msms_count_threshold is None:
+        significance_threshold, msms_count_threshold = select_thresholds()
     
-    experimental_data = experimental_data[
-        (experimental_data['MS/MS Count'] >= msms_count_threshold) &
-        (experimental_data['PEP'] <= significance_threshold) &
-        (experimental_data['Potential contaminant'].isna())
-    ]
-    
-    # Remove rows only if ALL experiments have Intensity ≤ 0 and Count = 0
-    mask_intensity = ~(experimental_data[[f'Intensity {exp}' for exp, _ in experiment_list]] <= 0).all(axis=1)
-    mask_count = ~(experimental_data[[f'Count {exp}' for exp, _ in experiment_list]] == 0).all(axis=1)
-    experimental_data = experimental_data.loc[mask_intensity & mask_count]
-    
-    return experimental_data
+    keep = get_row_mask(experiment_list, experimental_data, significance_threshold, msms_count_threshold)
+    return experimental_data.loc[keep]
 
-def filter_data_without_controls(experiment_list, experimental_data):
+@profiling.profiled
+def filter_data_without_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None):
     """Filter data for experiments without controls"""
     print("Filtering experimental data")
     experimental_data = remove_nan_without_controls(experiment_list, experimental_data)
-    print("\n")    
-    significance_threshold = select_significance()
-    msms_count_threshold = select_msms_count()
-    print("\n")
-    experimental_data = experimental_data[
-        (experimental_data['MS/MS Count'] >= msms_count_threshold) &
-        (experimental_data['PEP'] <= significance_threshold) &
-        (experimental_data['Potential contaminant'].isna())
-    ]
-    # Remove rows only if ALL experiments have Intensity ≤ 0 and Count = 0
-    mask_intensity = ~(experimental_data[[f'Intensity {exp}' for exp in experiment_list]] <= 0).all(axis=1)
-    mask_count = ~(experimental_data[[f'Experiment {exp}' for exp in experiment_list]] == 0).all(axis=1)
-    experimental_data = experimental_data.loc[mask_intensity & mask_count]
-    return experimental_data
+    if significance_threshold is None or msms_count_threshold is None:
+        significance_threshold, msms_count_threshold = select_thresholds()
+    keep = get_row_mask(experiment_list, experimental_data, significance_threshold, msms_count_threshold)
+    return experimental_data.loc[keep]
+
+@profiling.profiled
+def combine_rows_with_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None,
+                               workers=None, normalization=None):
+    """Aggregate rows by protein name for experiments with controls
 
-def combine_rows_with_controls(experiment_list, experimental_data):
-    """Aggregate rows by protein name for experiments with controls"""
+    The filters are applied as a row mask during aggregation, so the
+    surviving peptides are never copied into a separate frame. With workers,
+    the proteins are aggregated in that many processes. With normalization,
+    the samples are normalized before their controls are subtracted.
+    """
     print('Aggregating rows by protein name')
-    experimental_data = filter_data_with_controls(experiment_list, experimental_data)
-    grouped_data = experimental_data.groupby('Protein names').agg(lambda x: x.sum() if np.issubdtype(x.dtype, np.number) else x.iloc[0])
-    grouped_data.reset_index(inplace=True)
+    if significance_threshold is None or msms_count_threshold is None:
+        significance_threshold, msms_count_threshold = select_thresholds()
+    if normalization:
+        rows = get_threshold_mask(experimental_data, significance_threshold, msms_count_threshold)
+        experimental_data = normalize_samples(experiment_list, experimental_data, normalization, rows)
+    experimental_data = normalize_intensity(experiment_list, experimental_data)
+    keep = get_row_mask(experiment_list, experimental_data, significance_threshold, msms_count_threshold)
+    grouped_data = aggregation.aggregate_by_protein(experimental_data, mask=keep, workers=workers)
 
     return grouped_data
 
-def combine_rows_without_controls(experiment_list, experimental_data):
-    """Aggregate rows by protein name for experiments without controls"""
+@profiling.profiled
+def combine_rows_without_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None,
+                                  workers=None, normalization=None):
+    """Aggregate rows by protein name for experiments without controls
+
+    The filters are applied as a row mask during aggregation, so the
+    surviving peptides are never copied into a separate frame. With workers,
+    the proteins are aggregated in that many processes. With normalization,
+    the sample intensities are normalized first.
+    """
     print("Aggregating rows by protein name")
-    experimental_data = filter_data_without_controls(experiment_list, experimental_data)
-    grouped_data = experimental_data.groupby('Protein names').agg(lambda x: x.sum() if np.issubdtype(x.dtype, np.number) else x.iloc[0])
-    grouped_data.reset_index(inplace=True)
+    if significance_threshold is None or msms_count_threshold is None:
+        significance_threshold, msms_count_threshold = select_thresholds()
+    if normalization:
+        rows = get_threshold_mask(experimental_data, significance_threshold, msms_count_threshold)
+        experimental_data = normalize_samples(experiment_list, experimental_data, normalization, rows)
+    keep = get_row_mask(experiment_list, experimental_data, significance_threshold, msms_count_threshold)
+    grouped_data = aggregation.aggregate_by_protein(experimental_data, mask=keep, workers=workers)
     return grouped_data
 
-def remove_extra_columns_with_controls(experiment_list, experimental_data):
-    """Remove unnecessary columns for experiments with controls"""
-    print('Removing extra columns')
-    experimental_data = combine_rows_with_controls(experiment_list, experimental_data)
-    
+def get_columns_to_drop(experiment_list, columns):
+    """List the columns of an aggregated table that are not needed for the analyses"""
     # Define columns to drop
     columns_to_drop = [
         'Peptide IDs', 'Peptide is razor', 'Mod. peptide IDs', 'Evidence IDs', 
@@ -185,45 +351,76 @@ def remove_extra_columns_with_controls(experiment_list, experimental_data):
     ]
     
     # Dynamically remove experiment-specific columns
-    for experiment, control in experiment_list:
-        columns_to_drop.extend([
-            f'Intensity {experiment}', f'Intensity {control}',
-            f'Experiment {experiment}', f'Experiment {control}'
-        ])
+    if isinstance(experiment_list[0], tuple):
+        for experiment, control in experiment_list:
+            columns_to_drop.extend([
+                f'Intensity {experiment}', f'Intensity {control}',
+                f'Experiment {experiment}', f'Experiment {control}'
+            ])
     
     # Filter columns to drop only those that actually exist in the dataframe
-    columns_to_drop = [col for col in columns_to_drop if col in experimental_data.columns]
+    return [col for col in columns_to_drop if col in columns]
+
+@profiling.profiled
+def remove_extra_columns_with_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None,
+                                        results_dir="results", existing_data=None, workers=None, normalization=None,
+                                        writer=None, aggregated_format='csv'):
+    """Remove unnecessary columns for experiments with controls
+
+    If existing_data is given, the newly aggregated proteins are merged into
+    it before saving.
+    """
+    print('Removing extra columns')
+    experimental_data = combine_rows_with_controls(
+        experiment_list, experimental_data, significance_threshold, msms_count_threshold, workers, normalization
+    )
     
+    columns_to_drop = get_columns_to_drop(experiment_list, experimental_data.columns)
     experimental_data = experimental_data.drop(columns=columns_to_drop, errors='ignore')
-    experimental_data.to_csv("results/aggregated_data.csv", index=False)
+    if existing_data is not None:
+        experimental_data = aggregation.merge_aggregates(existing_data, experimental_data)
+    write_results(experimental_data, "aggregated_data", results_dir, writer, aggregated_format)
     return experimental_data
 
-def remove_extra_columns_without_controls(experiment_list, experimental_data):
-    """Remove unnecessary columns for experiments without controls"""
+@profiling.profiled
+def remove_extra_columns_without_controls(experiment_list, experimental_data, significance_threshold=None, msms_count_threshold=None,
+                                           results_dir="results", existing_data=None, workers=None, normalization=None,
+                                           writer=None, aggregated_format='csv'):
+    """Remove unnecessary columns for experiments without controls
+
+    If existing_data is given, the newly aggregated proteins are merged into
+    it before saving.
+    """
     print("Dropping unnecessary columns")
-    experimental_data = combine_rows_without_controls(experiment_list, experimental_data)
-    
-    # Define columns to drop
-    columns_to_drop = [
-        'Peptide IDs', 'Peptide is razor', 'Mod. peptide IDs', 'Evidence IDs', 
-        'MS/MS IDs', 'Best MS/MS', 'Reverse', 'Potential contaminant', 'id', 
-        'Peptide counts (all)', 'Peptide counts (razor unique)', 'Protein IDs',
-        'Peptide counts (unique)', 'Sequence coverage [%]', 'Unique + razor sequence coverage [%]',
-        'Sequence coverage [%]', 'Mol. weight [kDa]', 'Sequence length', 'Q-value',
-        'Score', 'Fasta headers'
-    ]
-    
-    # Filter columns to drop only those that actually exist in the dataframe
-    columns_to_drop = [col for col in columns_to_drop if col in experimental_data.columns]
+    experimental_data = combine_rows_without_controls(
+        experiment_list, experimental_data, significance_threshold, msms_count_threshold, workers, normalization
+    )
     
+    columns_to_drop = get_columns_to_drop(experiment_list, experimental_data.columns)
     experimental_data = experimental_data.drop(columns=columns_to_drop, errors='ignore')
-    experimental_data.to_csv("results/aggregated_data.csv", index=False)
+    if existing_data is not None:
+        experimental_data = aggregation.merge_aggregates(existing_data, experimental_data)
+    write_results(experimental_data, "aggregated_data", results_dir, writer, aggregated_format)
     return experimental_data
 
 # ===== ANALYSIS FUNCTIONS =====
 
-def get_differentially_expressed(experiment_list, experimental_data):
-    """Generate a list of differentially expressed proteins"""
+# The analyses take the aggregated table, or the path of a saved one
+# (memory-mapped if it is an Arrow file, see load_data.load_aggregated)
+
+@profiling.profiled
+def get_differentially_expressed(experiment_list, experimental_data, log2fc_selection=None, results_dir="results",
+                                 replicates=None, moderated=False, writer=None):
+    """Generate a list of differentially expressed proteins
+
+    With replicates, a mapping of conditions to their experiments, every pair
+    of conditions is also tested across replicates (Welch's t-test, or the
+    moderated t-test with moderated set) and the mean log2 fold change,
+    p-value and BH q-value of each comparison are added to the list. The
+    list is saved with writer if given, else to results_dir unless that is
+    None.
+    """
+    experimental_data = load_data.load_aggregated(experimental_data)
     print("Generating a list of differentially expressed proteins.\n")
     
     # For with_controls case, experiment_list contains tuples (exp, control)
@@ -232,40 +429,140 @@ def get_differentially_expressed(experiment_list, experimental_data):
     if isinstance(experiment_list[0], tuple):
         # Extract experiment names from experiment_list tuples
         exp_names = [exp for exp, _ in experiment_list]
-        
-        condition = (experimental_data[[f'Count {exp}' for exp in exp_names]] != 0).all(axis=1) & \
-                    (experimental_data[[f'Intensity Experiment {exp}' for exp in exp_names]] > 0).all(axis=1)
     else:
         # For without_controls, we need to create intensity columns first
-        for exp in experiment_list:
-            experimental_data[f'Intensity Experiment {exp}'] = experimental_data[f'Intensity {exp}']
-            experimental_data[f'Count {exp}'] = experimental_data[f'Experiment {exp}']
-        
-        condition = (experimental_data[[f'Count {exp}' for exp in experiment_list]] != 0).all(axis=1) & \
-                    (experimental_data[[f'Intensity Experiment {exp}' for exp in experiment_list]] > 0).all(axis=1)
-        
+        experimental_data = add_experiment_columns(experiment_list, experimental_data)
         exp_names = experiment_list
     
+    # Imputed intensities stand in for missing ones, whatever their count
+    detected = (experimental_data[[f'Count {exp}' for exp in exp_names]] != 0).to_numpy() & \
+               (experimental_data[[f'Intensity Experiment {exp}' for exp in exp_names]] > 0).to_numpy()
+    condition = (detected | get_imputed_mask(exp_names, experimental_data)).all(axis=1)
+    
     differential_expression = experimental_data.loc[condition]
     
     if len(exp_names) < 2:
         print("Need at least two experiments to calculate fold change.")
         return differential_expression
     
-    user_selection = select_log2fc(exp_names)
-    exp1_idx, exp2_idx = map(int, user_selection.split('/'))
+    if log2fc_selection is None:
+        log2fc_selection = select_log2fc(exp_names)
+    exp1_idx, exp2_idx = map(int, log2fc_selection.split('/'))
     exp1, exp2 = exp_names[exp1_idx - 1], exp_names[exp2_idx - 1]
     
-    differential_expression[f'Log2FC {exp1}/{exp2}'] = np.log2(
+    differential_expression = differential_expression.assign(**{f'Log2FC {exp1}/{exp2}': np.log2(
         differential_expression[f'Intensity Experiment {exp1}'] /
         differential_expression[f'Intensity Experiment {exp2}']
-    )
-    
-    differential_expression.to_csv("results/differential_expression.csv", index=False)
+    )})
+    if replicates:
+        # Tested over all proteins, so the q-values account for every test
+        exp_names, intensity, _ = get_experiment_matrices(experiment_list, experimental_data)
+        statistics = replicate_stats.test_replicates(
+            exp_names, intensity, replicates, moderated=moderated, index=experimental_data.index
+        )
+        differential_expression = differential_expression.join(statistics)
+    
+    write_results(differential_expression, "differential_expression", results_dir, writer)
     return differential_expression
 
-def get_experiment_exclusive(experiment_list, experimental_data, exp_index):
+def get_experiment_matrices(experiment_list, experimental_data):
+    """Return experiment names with their N x E intensity and count arrays
+
+    Uses the control-normalized columns for experiments with controls and the
+    raw columns otherwise, without adding columns to experimental_data.
+    Missing counts are returned as zeros.
+    """
+    if isinstance(experiment_list[0], tuple):
+        matrix = ExperimentMatrix.from_frame(
+            experimental_data, [exp for exp, _ in experiment_list], 'Intensity Experiment ', 'Count '
+        )
+    else:
+        matrix = ExperimentMatrix.from_frame(experimental_data, list(experiment_list))
+    return matrix.names, matrix.intensity, matrix.count
+
+def get_imputed_mask(exp_names, experimental_data):
+    """N x E mask of the intensities filled in by impute_missing (none if it was not run)"""
+    columns = [f'Imputed {exp}' for exp in exp_names]
+    if not all(column in experimental_data.columns for column in columns):
+        return np.zeros((len(experimental_data), len(exp_names)), dtype=bool)
+    return experimental_data[columns].to_numpy(dtype=bool)
+
+@profiling.profiled
+def impute_missing(experiment_list, experimental_data, method, seed=0):
+    """Impute the missing intensities of the analysed experiments
+
+    method is 'normal', 'min' or 'knn' (see imputation.py); intensities of
+    zero or less count as missing. Returns a new table with the imputed
+    intensities in place and an 'Imputed X' column flagging them for every
+    experiment X.
+    """
+    print(f"Imputing missing intensities ({method})")
+    exp_names, intensity, _ = get_experiment_matrices(experiment_list, experimental_data)
+    intensity, imputed = imputation.impute(intensity, method, seed)
+
+    if isinstance(experiment_list[0], tuple):
+        prefixes = ['Intensity Experiment ']
+    else:
+        # Also update the copies made by add_experiment_columns, if any
+        prefixes = ['Intensity ', 'Intensity Experiment ']
+    columns = pd.DataFrame({
+        f'{prefix}{exp}': intensity[:, i] for prefix in prefixes for i, exp in enumerate(exp_names)
+        if f'{prefix}{exp}' in experimental_data.columns
+    }, index=experimental_data.index)
+    flags = pd.DataFrame({f'Imputed {exp}': imputed[:, i] for i, exp in enumerate(exp_names)},
+                         index=experimental_data.index)
+    return append_columns(replace_columns(experimental_data, columns), flags)
+
+@profiling.profiled
+def get_all_log2fc(experiment_list, experimental_data, ordered=False, top_k=None, results_dir="results", writer=None):
+    """Compute the log2 fold change of every experiment pair in one pass
+
+    A protein is reported for a pair when both experiments have a non-zero
+    count and a positive intensity, or an imputed intensity. With top_k,
+    only the k proteins with the largest absolute fold change are kept for
+    each pair.
+    """
+    experimental_data = load_data.load_aggregated(experimental_data)
+    print("Calculating Log2 fold change for all experiment pairs.")
+    exp_names, intensity, count = get_experiment_matrices(experiment_list, experimental_data)
+
+    if ordered:
+        numerator, denominator = np.nonzero(~np.eye(len(exp_names), dtype=bool))
+    else:
+        numerator, denominator = np.triu_indices(len(exp_names), 1)
+
+    present = ((count != 0) & (intensity > 0)) | get_imputed_mask(exp_names, experimental_data)
+    valid = present[:, numerator] & present[:, denominator]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log2fc = np.log2(intensity[:, numerator] / intensity[:, denominator])
+
+    # Lay results out pair by pair
+    valid, log2fc = valid.T, log2fc.T
+    if top_k is not None and top_k < valid.shape[1]:
+        magnitude = np.where(valid, np.abs(log2fc), -np.inf)
+        top = np.argpartition(-magnitude, top_k - 1, axis=1)[:, :top_k]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(magnitude, top, axis=1), axis=1), axis=1)
+        pair_index = np.repeat(np.arange(len(numerator)), top_k)
+        protein_index = top.ravel()
+        keep = valid[pair_index, protein_index]
+        pair_index, protein_index = pair_index[keep], protein_index[keep]
+    else:
+        pair_index, protein_index = np.nonzero(valid)
+
+    exp_names = np.asarray(exp_names, dtype=object)
+    all_log2fc = pd.DataFrame({
+        'Protein names': experimental_data['Protein names'].to_numpy()[protein_index],
+        'Numerator': exp_names[numerator[pair_index]],
+        'Denominator': exp_names[denominator[pair_index]],
+        'Log2FC': log2fc[pair_index, protein_index],
+    })
+    write_results(all_log2fc, "log2fc_all_pairs", results_dir, writer)
+    return all_log2fc
+
+@profiling.profiled
+def get_experiment_exclusive(experiment_list, experimental_data, exp_index, results_dir="results", writer=None):
     """Generate a list of proteins expressed exclusively in one experiment"""
+    experimental_data = load_data.load_aggregated(experimental_data)
     # Handle both with_controls and without_controls cases
     if isinstance(experiment_list[0], tuple):
         exp = experiment_list[exp_index][0]  # Extract experiment name from the tuple
@@ -278,9 +575,7 @@ def get_experiment_exclusive(experiment_list, experimental_data, exp_index):
     
     # Create intensity columns if they don't exist (for without_controls case)
     if f'Count {exp}' not in experimental_data.columns:
-        for e in exp_names:
-            experimental_data[f'Intensity Experiment {e}'] = experimental_data[f'Intensity {e}']
-            experimental_data[f'Count {e}'] = experimental_data[f'Experiment {e}']
+        experimental_data = add_experiment_columns(exp_names, experimental_data)
     
     condition = (experimental_data[f'Count {exp}'] > 0) & \
                 (experimental_data[f'Intensity Experiment {exp}'] > 0)
@@ -291,68 +586,256 @@ def get_experiment_exclusive(experiment_list, experimental_data, exp_index):
                          (experimental_data[f'Intensity Experiment {other_exp}'] <= 0)
     
     exclusive_expression = experimental_data.loc[condition]
-    exclusive_expression.to_csv(f"results/{exp}_exclusive_expression.csv", index=False)
+    write_results(exclusive_expression, f"{exp}_exclusive_expression", results_dir, writer)
     return exclusive_expression
 
+def get_presence_masks(experiment_list, experimental_data):
+    """Boolean proteins x experiments matrices of presence and absence
+
+    A protein is present in an experiment with a positive count and
+    intensity, and absent when both are zero or less.
+    """
+    exp_names, intensity, count = get_experiment_matrices(experiment_list, experimental_data)
+    present = (count > 0) & (intensity > 0)
+    absent = (count <= 0) & (intensity <= 0)
+    return exp_names, present, absent
+
+@profiling.profiled
+def get_all_exclusive(experiment_list, experimental_data, upset=False, results_dir="results", writer=None):
+    """Generate the exclusive protein lists of every experiment in one pass
+
+    A protein is exclusive to an experiment when it is present there and
+    absent from all the others. With upset, the number of proteins sharing
+    each presence pattern is written to upset_intersections.csv.
+    """
+    experimental_data = load_data.load_aggregated(experimental_data)
+    exp_names, present, absent = get_presence_masks(experiment_list, experimental_data)
+    exclusive_mask = present & (absent.sum(axis=1) == len(exp_names) - 1)[:, None]
+
+    exclusive = {}
+    for i, exp in enumerate(exp_names):
+        print(f"Generating a list of proteins expressed exclusively in {exp}.")
+        exclusive[exp] = experimental_data.loc[exclusive_mask[:, i]]
+        write_results(exclusive[exp], f"{exp}_exclusive_expression", results_dir, writer)
+
+    if upset:
+        # Pack the patterns last experiment first, so they sort as before
+        packed = np.packbits(present[present.any(axis=1), ::-1], axis=1)
+        patterns, proteins = np.unique(packed, axis=0, return_counts=True)
+        patterns = np.unpackbits(patterns, axis=1, count=len(exp_names))[:, ::-1].astype(bool)
+        intersections = pd.DataFrame({exp: patterns[:, i] for i, exp in enumerate(exp_names)})
+        intersections['Proteins'] = proteins
+        intersections = intersections.sort_values('Proteins', ascending=False, kind='stable')
+        write_results(intersections, "upset_intersections", results_dir, writer)
+
+    return exclusive
+
 # ===== MAIN FUNCTIONS =====
 
-def process_with_controls(experimental_data_txt):
-    """Process data for experiments with controls"""
-    print("Normalize MaxQuant peptides.txt by Intensity and aggregate by Protein names\n")
-    experiment_list = get_experiments_with_controls()
-    experimental_data = convert_txt(experimental_data_txt)
-    
-    # Process data
-    processed_data = remove_extra_columns_with_controls(experiment_list, experimental_data)
-    
-    # Run analyses
-    print("\nRunning analyses...")
-    get_differentially_expressed(experiment_list, processed_data)
-    
-    # Generate exclusivity reports for each experiment
-    for i in range(len(experiment_list)):
-        get_experiment_exclusive(experiment_list, processed_data, i)
-    
-    print("All analyses complete.")
-    return processed_data
+def process_with_controls(experimental_data_txt, experiment_list=None, significance_threshold=None,
+                          msms_count_threshold=None, log2fc_selection=None, results_dir="results",
+                          chunksize=None, compact=False, cache=False, all_pairs=False, ordered_pairs=False,
+                          top_k=None, upset=False, append=False, profile=None, profile_dump=None, workers=None,
+                          evidence=False, replicates=None, moderated=False, normalization=None,
+                          impute=None, seed=0, bundle=False, aggregated_format='csv'):
+    """Process data for experiments with controls
 
-def process_without_controls(experimental_data_txt):
-    """Process data for experiments without controls"""
-    print("Filter MaxQuant data and aggregate rows by protein name")
-    experiment_list = get_experiments_without_controls()
-    experimental_data = convert_txt(experimental_data_txt)
-    
-    # Process data
-    processed_data = remove_extra_columns_without_controls(experiment_list, experimental_data)
-    
-    # Run analyses
-    print("\nRunning analyses...")
-    get_differentially_expressed(experiment_list, processed_data)
-    
-    # Generate exclusivity reports for each experiment
-    for i in range(len(experiment_list)):
-        get_experiment_exclusive(experiment_list, processed_data, i)
-    
-    print("All analyses complete.")
-    return processed_data
+    Any of experiment_list, the thresholds and log2fc_selection that are not
+    given are asked for interactively. With append, the peptides are merged
+    into the aggregated_data.csv already in results_dir. With profile, a JSON
+    report of the cost of every stage is written to that path, and with
+    profile_dump a flat cProfile dump. With workers, proteins are aggregated
+    in that many processes. With evidence, the input is evidence.txt rather
+    than peptides.txt. With replicates, conditions are compared across their
+    replicate experiments (see get_differentially_expressed). With
+    normalization ('median', 'total' or 'quantile'), the sample intensities
+    are normalized against each other before aggregation. With impute
+    ('normal', 'min' or 'knn', seeded with seed), missing intensities are
+    imputed for the fold change and replicate analyses; the exclusivity
+    reports still use the measured intensities only. With bundle, the
+    results are saved as one Parquet bundle in results_dir/results_bundle
+    instead of separate CSV files (see results_bundle.py). aggregated_format
+    ('csv', 'arrow' or 'parquet') is the format of the aggregated table
+    otherwise. Results are written on a background thread while the
+    analyses run, and all of them are on disk when this returns.
+    """
+    bundle_writer = results_bundle.BundleWriter(os.path.join(results_dir, results_bundle.BUNDLE_DIR)) if bundle else None
+    with profiling.profile(profile, profile_dump), results_bundle.BackgroundWriter(results_dir, bundle_writer) as writer:
+        print("Normalize MaxQuant peptides.txt by Intensity and aggregate by Protein names\n")
+        experiment_list = preflight(experimental_data_txt, experiment_list, True, evidence)
+        if significance_threshold is None or msms_count_threshold is None:
+            significance_threshold, msms_count_threshold = select_thresholds()
+        os.makedirs(results_dir, exist_ok=True)
+        parameters = aggregation.get_aggregation_parameters(
+            experiment_list, significance_threshold, msms_count_threshold, normalization
+        )
+        existing_data = aggregation.load_aggregated_data(parameters, results_dir) if append else None
+        experimental_data = convert_txt(
+            experimental_data_txt, significance_threshold, msms_count_threshold, chunksize, experiment_list, compact, cache,
+            evidence
+        )
+    
+        # Process data
+        processed_data = remove_extra_columns_with_controls(
+            experiment_list, experimental_data, significance_threshold, msms_count_threshold, results_dir, existing_data,
+            workers, normalization, writer, aggregated_format
+        )
+        aggregation.save_aggregation_parameters(parameters, results_dir)
+        analysis_data = processed_data
+        if impute:
+            analysis_data = impute_missing(experiment_list, processed_data, impute, seed)
+    
+        # Run analyses
+        print("\nRunning analyses...")
+        get_differentially_expressed(
+            experiment_list, analysis_data, log2fc_selection, results_dir, replicates, moderated, writer
+        )
+        if all_pairs:
+            get_all_log2fc(experiment_list, analysis_data, ordered_pairs, top_k, results_dir, writer)
+    
+        # Generate exclusivity reports for each experiment
+        get_all_exclusive(experiment_list, processed_data, upset, results_dir, writer)
+    
+        print("All analyses complete.")
+        return processed_data
+
+def process_without_controls(experimental_data_txt, experiment_list=None, significance_threshold=None,
+                             msms_count_threshold=None, log2fc_selection=None, results_dir="results",
+                             chunksize=None, compact=False, cache=False, all_pairs=False, ordered_pairs=False,
+                             top_k=None, upset=False, append=False, profile=None, profile_dump=None, workers=None,
+                             evidence=False, replicates=None, moderated=False, normalization=None,
+                             impute=None, seed=0, bundle=False, aggregated_format='csv'):
+    """Process data for experiments without controls
+
+    Any of experiment_list, the thresholds and log2fc_selection that are not
+    given are asked for interactively. With append, the peptides are merged
+    into the aggregated_data.csv already in results_dir. With profile, a JSON
+    report of the cost of every stage is written to that path, and with
+    profile_dump a flat cProfile dump. With workers, proteins are aggregated
+    in that many processes. With evidence, the input is evidence.txt rather
+    than peptides.txt. With replicates, conditions are compared across their
+    replicate experiments (see get_differentially_expressed). With
+    normalization ('median', 'total' or 'quantile'), the sample intensities
+    are normalized against each other before aggregation. With impute
+    ('normal', 'min' or 'knn', seeded with seed), missing intensities are
+    imputed for the fold change and replicate analyses; the exclusivity
+    reports still use the measured intensities only. With bundle, the
+    results are saved as one Parquet bundle in results_dir/results_bundle
+    instead of separate CSV files (see results_bundle.py). aggregated_format
+    ('csv', 'arrow' or 'parquet') is the format of the aggregated table
+    otherwise. Results are written on a background thread while the
+    analyses run, and all of them are on disk when this returns.
+    """
+    bundle_writer = results_bundle.BundleWriter(os.path.join(results_dir, results_bundle.BUNDLE_DIR)) if bundle else None
+    with profiling.profile(profile, profile_dump), results_bundle.BackgroundWriter(results_dir, bundle_writer) as writer:
+        print("Filter MaxQuant data and aggregate rows by protein name")
+        experiment_list = preflight(experimental_data_txt, experiment_list, False, evidence)
+        if significance_threshold is None or msms_count_threshold is None:
+            significance_threshold, msms_count_threshold = select_thresholds()
+        os.makedirs(results_dir, exist_ok=True)
+        parameters = aggregation.get_aggregation_parameters(
+            experiment_list, significance_threshold, msms_count_threshold, normalization
+        )
+        existing_data = aggregation.load_aggregated_data(parameters, results_dir) if append else None
+        experimental_data = convert_txt(
+            experimental_data_txt, significance_threshold, msms_count_threshold, chunksize, experiment_list, compact, cache,
+            evidence
+        )
+    
+        # Process data
+        processed_data = remove_extra_columns_without_controls(
+            experiment_list, experimental_data, significance_threshold, msms_count_threshold, results_dir, existing_data,
+            workers, normalization, writer, aggregated_format
+        )
+        aggregation.save_aggregation_parameters(parameters, results_dir)
+        processed_data = add_experiment_columns(experiment_list, processed_data)
+        analysis_data = processed_data
+        if impute:
+            analysis_data = impute_missing(experiment_list, processed_data, impute, seed)
+    
+        # Run analyses
+        print("\nRunning analyses...")
+        get_differentially_expressed(
+            experiment_list, analysis_data, log2fc_selection, results_dir, replicates, moderated, writer
+        )
+        if all_pairs:
+            get_all_log2fc(experiment_list, analysis_data, ordered_pairs, top_k, results_dir, writer)
+    
+        # Generate exclusivity reports for each experiment
+        get_all_exclusive(experiment_list, processed_data, upset, results_dir, writer)
+    
+        print("All analyses complete.")
+        return processed_data
 
 def main():
     """Main function to run the program"""
     parser = argparse.ArgumentParser(description='Process MaxQuant proteomics data.')
-    parser.add_argument('input_file', help='Path to the peptides.txt file from MaxQuant')
+    parser.add_argument('input_file', help='Path to the peptides.txt (or, with --evidence, evidence.txt) file from MaxQuant, optionally '
+                             'compressed as .gz, .zst, .bz2 or .xz')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream peptides.txt in chunks of this many rows, filtering each chunk as it is read')
+    parser.add_argument('--compact', action='store_true',
+                        help='Only parse the columns needed for the selected experiments, using compact dtypes')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep a binary copy of the parsed peptides.txt to speed up later runs on the same file')
+    parser.add_argument('--all-pairs', action='store_true',
+                        help='Also write the Log2 fold change of every experiment pair to log2fc_all_pairs.csv')
+    parser.add_argument('--ordered', action='store_true',
+                        help='With --all-pairs, include both directions of each pair')
+    parser.add_argument('--top-k', type=int, default=None,
+                        help='With --all-pairs, keep only the k proteins with the largest absolute fold change per pair')
+    parser.add_argument('--upset', action='store_true',
+                        help='Also write the number of proteins in every experiment intersection to upset_intersections.csv')
+    parser.add_argument('--append', action='store_true',
+                        help='Merge the peptides into the existing results/aggregated_data.csv instead of starting over')
+    parser.add_argument('--profile', default=None, metavar='REPORT_JSON',
+                        help='Write the time, memory and row counts of every stage to this JSON file')
+    parser.add_argument('--profile-dump', default=None, metavar='PROFILE_FILE',
+                        help='Write a flat cProfile dump of the run to this file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Aggregate proteins in this many worker processes')
+    parser.add_argument('--evidence', action='store_true',
+                        help='The input is evidence.txt; roll it up into peptides while streaming it')
+    parser.add_argument('--replicates', default=None, metavar='JSON',
+                        help='Condition -> replicate experiments mapping (JSON file or string); adds t-test p-values '
+                             'and BH q-values for every pair of conditions to differential_expression.csv')
+    parser.add_argument('--moderated', action='store_true',
+                        help='With --replicates, use a moderated (limma-style) t-test instead of Welch\'s')
+    parser.add_argument('--impute', choices=imputation.IMPUTATIONS, default=None,
+                        help='Impute missing intensities for the fold change and replicate analyses: down-shifted '
+                             'normal draws, the per-experiment minimum, or the mean of the nearest proteins')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='With --impute, seed for the random draws')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Save all results as one Parquet bundle in results/results_bundle instead of separate CSV '
+                             'files')
+    parser.add_argument('--aggregated-format', choices=load_data.AGGREGATED_FORMATS, default='csv',
+                        help='Save the aggregated table as CSV, Arrow (memory-mapped when read back) or Parquet')
+    parser.add_argument('--normalization', choices=NORMALIZATIONS, default=None,
+                        help='Normalize the sample intensities against each other before aggregating: median '
+                             'centering, total intensity scaling or quantile normalization')
     args = parser.parse_args()
     
     print("===== MaxQuant Proteomics Data Analysis =====")
     print("This program will process your proteomics data and generate analysis reports.")
     
     analysis_type = get_analysis_type()
+    options = dict(
+        chunksize=args.chunksize, compact=args.compact, cache=args.cache,
+        all_pairs=args.all_pairs, ordered_pairs=args.ordered, top_k=args.top_k,
+        upset=args.upset, append=args.append, profile=args.profile, profile_dump=args.profile_dump,
+        workers=args.workers, evidence=args.evidence, moderated=args.moderated,
+        normalization=args.normalization, impute=args.impute, seed=args.seed, bundle=args.bundle,
+        aggregated_format=args.aggregated_format,
+        replicates=replicate_stats.read_replicates(args.replicates) if args.replicates else None
+    )
     
     if analysis_type == 1:
         # Process with controls
-        process_with_controls(args.input_file)
+        process_with_controls(args.input_file, **options)
     else:
         # Process without controls
-        process_without_controls(args.input_file)
+        process_without_controls(args.input_file, **options)
     
     print("\nDone. Results saved in the 'results' directory.")
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Synthetic MaxQuant peptides.txt generator
+
+Writes peptides.txt files with MaxQuant's column layout for benchmarking.
+Peptides are spread over proteins following a Zipf distribution, intensities
+are log-normal with missing values recorded as MaxQuant does (0 intensity,
+empty experiment count), and a fraction of peptides are flagged as
+contaminants or reverse hits.
+
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+AMINO_ACIDS = np.array(list('ARNDCQEGHILKMFPSTWYVUO'))
+
+# ===== GENERATOR =====
+
+def get_sample_names(n_experiments):
+    """Name the samples; the second half serve as controls for the first"""
+    return [f'Sample{i + 1:02d}' for i in range(n_experiments)]
+
+def get_experiment_list(n_experiments, with_controls=True):
+    """Build the experiment list used by sort_data_master for synthetic samples"""
+    names = get_sample_names(n_experiments)
+    if not with_controls:
+        return names
+    half = n_experiments // 2
+    return list(zip(names[:half], names[half:2 * half]))
+
+def generate_chunk(rng, first_id, n_rows, n_proteins, sample_names, zipf_exponent=1.0,
+                   missing_rate=0.3, contaminant_rate=0.02, reverse_rate=0.01):
+    """Generate one chunk of peptide rows"""
+    ranks = np.arange(1, n_proteins + 1)
+    weights = ranks ** -zipf_exponent
+    protein = rng.choice(n_proteins, size=n_rows, p=weights / weights.sum())
+
+    length = rng.integers(7, 30, n_rows)
+    sequences = rng.choice(AMINO_ACIDS[:20], size=(n_rows, 30))
+    sequence = [''.join(row[:n]) for row, n in zip(sequences, length)]
+    ids = np.arange(first_id, first_id + n_rows)
+
+    contaminant = rng.random(n_rows) < contaminant_rate
+    reverse = rng.random(n_rows) < reverse_rate
+    protein_ids = np.char.add('P', protein.astype(str))
+
+    data = {
+        'Sequence': sequence,
+        'N-term cleavage window': [s[:15].ljust(31, '_') for s in sequence],
+        'C-term cleavage window': [s[-15:].rjust(31, '_') for s in sequence],
+        'Amino acid before': rng.choice(['K', 'R', '-'], n_rows),
+        'First amino acid': [s[0] for s in sequence],
+        'Second amino acid': [s[1] for s in sequence],
+        'Second last amino acid': [s[-2] for s in sequence],
+        'Last amino acid': [s[-1] for s in sequence],
+        'Amino acid after': rng.choice(AMINO_ACIDS[:20], n_rows),
+    }
+    for amino_acid in AMINO_ACIDS:
+        data[f'{amino_acid} Count'] = (sequences == amino_acid).sum(axis=1) if amino_acid not in 'UO' else 0
+    data.update({
+        'Length': length,
+        'Missed cleavages': rng.integers(0, 3, n_rows),
+        'Mass': length * 110.0 + rng.random(n_rows),
+        'Proteins': np.where(contaminant, np.char.add('CON__', protein_ids), protein_ids),
+        'Leading razor protein': protein_ids,
+        'Start position': rng.integers(1, 1000, n_rows),
+        'End position': rng.integers(1000, 2000, n_rows),
+        'Gene names': np.char.add('GENE', protein.astype(str)),
+        'Protein names': np.char.add('Protein ', protein.astype(str)),
+        'Unique (Groups)': rng.choice(['yes', 'no'], n_rows, p=[0.9, 0.1]),
+        'Unique (Proteins)': rng.choice(['yes', 'no'], n_rows, p=[0.8, 0.2]),
+        'Charges': rng.choice(['2', '3', '2;3'], n_rows),
+        'PEP': np.minimum(rng.lognormal(-5, 2, n_rows), 1.0),
+        'Score': rng.gamma(3, 30, n_rows),
+    })
+
+    observed = rng.random((n_rows, len(sample_names))) >= missing_rate
+    counts = np.where(observed, rng.geometric(0.5, (n_rows, len(sample_names))), np.nan)
+    abundance = rng.lognormal(16, 2, n_rows)[:, None] * rng.lognormal(0, 0.5, (n_rows, len(sample_names)))
+    intensities = np.where(observed, np.round(abundance), 0.0)
+    for i, name in enumerate(sample_names):
+        data[f'Experiment {name}'] = counts[:, i]
+    data['Intensity'] = intensities.sum(axis=1)
+    for i, name in enumerate(sample_names):
+        data[f'Intensity {name}'] = intensities[:, i]
+
+    data.update({
+        'Reverse': np.where(reverse, '+', ''),
+        'Potential contaminant': np.where(contaminant, '+', ''),
+        'id': ids,
+        'Protein group IDs': protein.astype(str),
+        'Mod. peptide IDs': ids.astype(str),
+        'Evidence IDs': ids.astype(str),
+        'MS/MS IDs': ids.astype(str),
+        'Best MS/MS': ids,
+        'Taxonomy IDs': '9606',
+        'Taxonomy names': 'Homo sapiens',
+        'Mass deficit': rng.normal(0, 0.05, n_rows),
+        'Deamidation (N) site IDs': '',
+        'MS/MS Count': np.nan_to_num(counts).sum(axis=1).astype(np.int64),
+    })
+    return pd.DataFrame(data)
+
+def generate_peptides(path, n_rows, n_experiments, n_proteins=None, seed=0, chunksize=100000, **options):
+    """Write a synthetic peptides.txt with n_rows peptides and n_experiments samples"""
+    rng = np.random.default_rng(seed)
+    n_proteins = n_proteins or max(n_rows // 10, 1)
+    sample_names = get_sample_names(n_experiments)
+    for first_id in range(0, n_rows, chunksize):
+        chunk = generate_chunk(rng, first_id, min(chunksize, n_rows - first_id), n_proteins, sample_names, **options)
+        chunk.to_csv(path, sep='\t', index=False, mode='w' if first_id == 0 else 'a', header=first_id == 0)
+    return path
+
+def main():
+    """Main function to generate a synthetic peptides.txt"""
+    parser = argparse.ArgumentParser(description='Generate a synthetic MaxQuant peptides.txt.')
+    parser.add_argument('output_file', help='Path of the peptides.txt to write')
+    parser.add_argument('--rows', type=int, default=10000, help='Number of peptides (default: 10000)')
+    parser.add_argument('--experiments', type=int, default=4, help='Number of samples (default: 4)')
+    parser.add_argument('--proteins', type=int, default=None, help='Number of proteins (default: rows / 10)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    generate_peptides(args.output_file, args.rows, args.experiments, args.proteins, args.seed)
+    print(f"Wrote {args.rows} peptides for samples {', '.join(get_sample_names(args.experiments))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Aggregation engine against the groupby lambda it replaces
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aggregation
+
+def aggregate_with_groupby(experimental_data):
+    """The original per-group aggregation"""
+    return experimental_data.groupby('Protein names').agg(
+        lambda x: x.sum() if np.issubdtype(x.dtype, np.number) else x.iloc[0]
+    ).reset_index()
+
+def test_matches_groupby_above_block_size():
+    rng = np.random.default_rng(0)
+    sizes = [1, 7, 8, 129, 8192, 8193, 19215, 24577]
+    proteins = np.repeat([f'Protein {i}' for i in range(len(sizes))], sizes)
+    rng.shuffle(proteins)
+    rows = len(proteins)
+    experimental_data = pd.DataFrame({
+        'Protein names': proteins,
+        'Score': rng.random(rows) * rng.choice([1e-6, 1.0, 1e6], rows),
+        'PEP': rng.random(rows) * 1e-3,
+        'MS/MS Count': rng.integers(0, 10, rows),
+        'Sequence': [f'PEP{i}' for i in range(rows)],
+    })
+    experimental_data.loc[rng.random(rows) < 0.05, 'Score'] = np.nan
+
+    expected = aggregate_with_groupby(experimental_data)
+    pd.testing.assert_frame_equal(aggregation.aggregate_by_protein(experimental_data), expected, check_exact=True)
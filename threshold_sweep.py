@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+PEP x MS/MS count threshold sweep
+
+Loads peptides.txt once and reports, for every cell of a grid of PEP and
+MS/MS count thresholds, how many peptides and proteins survive filtering and
+how many proteins are differentially expressed or exclusive to each
+experiment.
+
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import sort_data_master as master
+
+# Upper bound on the proteins x PEP thresholds x experiments cells summed at once
+BLOCK_CELLS = 1 << 22
+
+# ===== PREPARATION =====
+
+def prepare_peptides(experiment_list, experimental_data):
+    """Normalize the peptides and keep the arrays the sweep needs"""
+    if isinstance(experiment_list[0], tuple):
+        experimental_data = master.normalize_intensity(experiment_list, experimental_data)
+
+    codes, proteins = pd.factorize(experimental_data['Protein names'])
+    keep = master.get_row_mask(experiment_list, experimental_data) & (codes >= 0)
+    exp_names, intensity, count = master.get_experiment_matrices(experiment_list, experimental_data)
+    return {
+        'exp_names': exp_names,
+        'n_proteins': len(proteins),
+        'protein': codes[keep],
+        'pep': experimental_data['PEP'].to_numpy(dtype=np.float64)[keep],
+        'msms': experimental_data['MS/MS Count'].to_numpy(dtype=np.float64)[keep],
+        'intensity': np.nan_to_num(intensity[keep], nan=0.0),
+        'count': np.nan_to_num(count[keep], nan=0.0),
+    }
+
+# ===== SWEEP =====
+
+def count_protein_block(peptides, rows, pep_bins, first, last, n_pep):
+    """Count surviving, differential and exclusive proteins in one protein block
+
+    Peptide sums are binned by the first PEP threshold that admits them, so
+    a cumulative sum over the bins gives each protein's totals at every PEP
+    threshold.
+    """
+    n_exp = len(peptides['exp_names'])
+    block = (peptides['protein'][rows] >= first) & (peptides['protein'][rows] < last)
+    key = (peptides['protein'][rows][block] - first) * (n_pep + 1) + pep_bins[block]
+    size = (last - first) * (n_pep + 1)
+
+    def cumulative(weights=None):
+        sums = np.bincount(key, weights=weights, minlength=size).reshape(last - first, n_pep + 1)
+        return np.cumsum(sums[:, :n_pep], axis=1)
+
+    survived = cumulative() > 0
+    intensity = np.stack([cumulative(peptides['intensity'][rows][block, e]) for e in range(n_exp)], axis=2)
+    count = np.stack([cumulative(peptides['count'][rows][block, e]) for e in range(n_exp)], axis=2)
+
+    present = (count > 0) & (intensity > 0)
+    absent = (count <= 0) & (intensity <= 0)
+    differential = survived & ((count != 0) & (intensity > 0)).all(axis=2)
+    n_absent = absent.sum(axis=2)
+    exclusive = survived[:, :, None] & present & (n_absent == n_exp - 1)[:, :, None]
+
+    return survived.sum(axis=0), differential.sum(axis=0), exclusive.sum(axis=0)
+
+def sweep_thresholds(experiment_list, experimental_data, pep_grid, msms_grid):
+    """Evaluate every PEP x MS/MS count threshold pair on data loaded once"""
+    print(f"Sweeping {len(pep_grid)} PEP x {len(msms_grid)} MS/MS count thresholds")
+    peptides = prepare_peptides(experiment_list, experimental_data)
+    exp_names = peptides['exp_names']
+    pep_grid = np.sort(np.asarray(pep_grid, dtype=np.float64))
+    msms_grid = np.sort(np.asarray(msms_grid, dtype=np.float64))
+    n_pep = len(pep_grid)
+    n_proteins = peptides['n_proteins']
+    proteins_per_block = max(1, BLOCK_CELLS // ((n_pep + 1) * max(len(exp_names), 1)))
+
+    rows_out = []
+    for msms_threshold in msms_grid:
+        rows = np.flatnonzero(peptides['msms'] >= msms_threshold)
+        pep_bins = np.searchsorted(pep_grid, peptides['pep'][rows], side='left')
+        n_peptides = np.cumsum(np.bincount(pep_bins, minlength=n_pep + 1)[:n_pep])
+
+        n_survived = np.zeros(n_pep, dtype=np.int64)
+        n_differential = np.zeros(n_pep, dtype=np.int64)
+        n_exclusive = np.zeros((n_pep, len(exp_names)), dtype=np.int64)
+        for first in range(0, n_proteins, proteins_per_block):
+            last = min(first + proteins_per_block, n_proteins)
+            survived, differential, exclusive = count_protein_block(peptides, rows, pep_bins, first, last, n_pep)
+            n_survived += survived
+            n_differential += differential
+            n_exclusive += exclusive
+
+        for p, pep_threshold in enumerate(pep_grid):
+            row = {
+                'PEP threshold': pep_threshold,
+                'MS/MS Count threshold': msms_threshold,
+                'Peptides': n_peptides[p],
+                'Proteins': n_survived[p],
+                'Differentially expressed': n_differential[p],
+            }
+            row.update({f'Exclusive {exp}': n_exclusive[p, e] for e, exp in enumerate(exp_names)})
+            rows_out.append(row)
+
+    return pd.DataFrame(rows_out)
+
+# ===== MAIN FUNCTIONS =====
+
+def main():
+    """Main function to run the sweep"""
+    parser = argparse.ArgumentParser(description='Sweep PEP and MS/MS count thresholds over MaxQuant data.')
+    parser.add_argument('input_file', help='Path to the peptides.txt file from MaxQuant')
+    parser.add_argument('--pep-grid', type=float, nargs=3, metavar=('START', 'STOP', 'NUM'), default=(0.001, 0.1, 50),
+                        help='Evenly spaced PEP upper thresholds (default: 0.001 0.1 50)')
+    parser.add_argument('--msms-grid', type=float, nargs=3, metavar=('START', 'STOP', 'NUM'), default=(1, 20, 20),
+                        help='Evenly spaced MS/MS count lower thresholds (default: 1 20 20)')
+    parser.add_argument('--compact', action='store_true',
+                        help='Only parse the columns needed for the selected experiments, using compact dtypes')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep a binary copy of the parsed peptides.txt to speed up later runs on the same file')
+    parser.add_argument('--results-dir', default='results', help='Directory for threshold_sweep.csv')
+    args = parser.parse_args()
+
+    analysis_type = master.get_analysis_type()
+    experiment_list = master.preflight(args.input_file, with_controls=analysis_type == 1)
+
+    experimental_data = master.convert_txt(
+        args.input_file, experiment_list=experiment_list, compact=args.compact, cache=args.cache
+    )
+    pep_grid = np.linspace(args.pep_grid[0], args.pep_grid[1], int(args.pep_grid[2]))
+    msms_grid = np.linspace(args.msms_grid[0], args.msms_grid[1], int(args.msms_grid[2]))
+    sweep = sweep_thresholds(experiment_list, experimental_data, pep_grid, msms_grid)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    sweep.to_csv(os.path.join(args.results_dir, "threshold_sweep.csv"), index=False)
+    print(f"\nDone. Results saved to {os.path.join(args.results_dir, 'threshold_sweep.csv')}")
+
+if __name__ == "__main__":
+    main()